@@ -0,0 +1,222 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from post import Post
+
+# "memory" keeps caches inside the process; "sqlite" shares them between
+# processes on the same host, e.g. when running several shard processes
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_PATH = os.getenv(
+    "CACHE_PATH", os.path.join(tempfile.gettempdir(), "scraper-cache.sqlite3")
+)
+
+
+# In-memory cache with a per-entry time to live and least-recently-used eviction
+class TTLCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.peek(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    # Look up a live entry without touching the hit/miss counters
+    def peek(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses}
+
+
+# Values are stored as JSON, never pickled, so whoever can write to the
+# cache file can't make the bot run code. Posts are tagged so they come
+# back as Post objects; tuples come back as lists.
+def encode(value):
+    def default(obj):
+        if isinstance(obj, Post):
+            return {"__post__": obj.to_dict()}
+        raise TypeError(f"Can't cache {type(obj).__name__} values")
+
+    return json.dumps(value, default=default)
+
+
+def decode(data):
+    def object_hook(obj):
+        if "__post__" in obj:
+            return Post.from_dict(obj["__post__"])
+        return obj
+
+    return json.loads(data, object_hook=object_hook)
+
+
+# TTLCache stored in a local SQLite file so every process on the host sees
+# the same entries. Expiry uses wall-clock time since it is shared between
+# processes; each namespace is evicted independently.
+class SQLiteTTLCache(TTLCache):
+    def __init__(self, path, namespace, max_entries):
+        super().__init__(max_entries)
+        self.namespace = namespace
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed_at)"
+        )
+
+    def peek(self, key):
+        key = repr(key)
+        row = self.connection.execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+            (self.namespace, key),
+        ).fetchone()
+        if row is None:
+            return None
+
+        value, expires_at = row
+        now = time.time()
+        try:
+            value = decode(value) if expires_at > now else None
+        except (ValueError, KeyError, TypeError):
+            value = None  # unreadable, e.g. written by an older version
+        if value is None:
+            self.connection.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            )
+            return None
+
+        self.connection.execute(
+            "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+            (now, self.namespace, key),
+        )
+        return value
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, repr(key), encode(value), now + ttl, now),
+        )
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                "SELECT key FROM cache WHERE namespace = ? "
+                "ORDER BY accessed_at LIMIT ?)",
+                (self.namespace, self.namespace, excess),
+            )
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+
+# Create a cache on the configured backend
+def make_cache(namespace, max_entries):
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteTTLCache(CACHE_PATH, namespace, max_entries)
+    return TTLCache(max_entries)
+
+
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", 256))
+
+# Seconds a listing stays fresh, by sort. Fast-moving sorts expire quickly.
+LISTING_TTLS = {
+    "new": 30,
+    "rising": 30,
+    "hot": 120,
+}
+# Seconds a top/controversial listing stays fresh, by time range
+TIME_RANGE_TTLS = {
+    "hour": 60,
+    "day": 300,
+    "week": 900,
+    "month": 1800,
+    "year": 3600,
+    "all": 3600,
+}
+
+
+# Caches subreddit listings keyed by (subreddit, filter_type, time_range).
+# A cached listing fetched with a larger limit also answers smaller limits.
+class ListingCache:
+    def __init__(self, max_entries=LISTING_CACHE_SIZE):
+        # Entries hold Post objects; the namespace changed from "listings"
+        # when listings stopped being cached as raw JSON
+        self.cache = make_cache("listing_posts", max_entries)
+
+    def key(self, subreddit, filter_type, time_range):
+        if filter_type in ["top", "controversial"]:
+            return (subreddit.lower(), filter_type, time_range)
+        elif filter_type in ["new", "rising"]:
+            return (subreddit.lower(), filter_type, None)
+        else:
+            return (subreddit.lower(), "hot", None)
+
+    def ttl(self, filter_type, time_range):
+        if filter_type in ["top", "controversial"]:
+            return TIME_RANGE_TTLS.get(time_range, TIME_RANGE_TTLS["day"])
+        return LISTING_TTLS.get(filter_type, LISTING_TTLS["hot"])
+
+    def get(self, subreddit, filter_type, time_range, limit):
+        entry = self.cache.peek(self.key(subreddit, filter_type, time_range))
+        # A listing shorter than the limit it was fetched with means the
+        # subreddit ran out of posts, so it still answers any larger limit
+        if entry is None or (entry[0] < limit and len(entry[1]) >= entry[0]):
+            self.cache.misses += 1
+            return None
+
+        self.cache.hits += 1
+        return entry[1][:limit]
+
+    # min_ttl keeps a top/controversial entry at least that long, e.g.
+    # until the cache warmer's next pass refreshes it. Hot, new and rising
+    # listings always keep their own short TTL so they stay fresh.
+    def set(self, subreddit, filter_type, time_range, limit, children, min_ttl=0):
+        key = self.key(subreddit, filter_type, time_range)
+        # Don't replace a fresh, larger listing with a smaller one
+        existing = self.cache.peek(key)
+        if existing and existing[0] > limit:
+            return
+        ttl = self.ttl(filter_type, time_range)
+        if filter_type in ["top", "controversial"]:
+            ttl = max(ttl, min_ttl)
+        self.cache.set(key, (limit, children), ttl)
+
+    def stats(self):
+        return self.cache.stats()
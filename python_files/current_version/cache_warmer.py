@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import log_config
+
+logger = logging.getLogger(__name__)
+
+# Seconds between warm-up passes. Set to 0 to turn the warmer off.
+CACHE_WARM_INTERVAL = int(os.getenv("CACHE_WARM_INTERVAL", 600))
+# Listings refreshed for every preset subreddit, as sort or sort:time_range.
+# Hot, new and rising listings expire on their own short TTL, so warming
+# them only helps scrapes that land shortly after a pass.
+CACHE_WARM_LISTINGS = os.getenv("CACHE_WARM_LISTINGS", "hot,top:day,top:week")
+# Posts fetched per warmed listing
+CACHE_WARM_LISTING_SIZE = 25
+# Warmed listings outlive the interval by this much, since the next pass
+# takes a while to get round to each one
+CACHE_WARM_TTL_MARGIN = 5 * 60  # seconds
+# Top posts per listing whose media is downloaded and transcoded ahead of time
+CACHE_WARM_MEDIA_POSTS = int(os.getenv("CACHE_WARM_MEDIA_POSTS", 3))
+
+
+# Turn "hot,top:day" into [("hot", None), ("top", "day")]
+def parse_listings(value):
+    listings = []
+    for entry in value.split(","):
+        filter_type, _, time_range = entry.strip().partition(":")
+        if filter_type:
+            listings.append((filter_type, time_range or None))
+    return listings
+
+
+# Keeps the listing and media caches warm for the preset subreddits, so
+# preset /scrape commands are served from data that is already prepared.
+# It only uses Reddit quota that users aren't waiting for, and prepares
+# one post at a time so it never crowds user jobs out of the ffmpeg pool.
+class CacheWarmer:
+    def __init__(
+        self,
+        scraper,
+        subreddits,
+        interval=CACHE_WARM_INTERVAL,
+        listings=CACHE_WARM_LISTINGS,
+        media_posts=CACHE_WARM_MEDIA_POSTS,
+    ):
+        self.scraper = scraper
+        self.subreddits = subreddits
+        self.interval = interval
+        self.listings = parse_listings(listings)
+        self.media_posts = media_posts
+        self.task = None
+
+    # Safe to call again on reconnect; only one warmer ever runs
+    def start(self):
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        log_config.job_id.set("cache-warmer")
+        while True:
+            try:
+                await self.warm()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Cache warm-up failed")
+            await asyncio.sleep(self.interval)
+
+    async def warm(self):
+        warmed = set()
+        for subreddit in self.subreddits:
+            for filter_type, time_range in self.listings:
+                # Leave the Reddit quota to users while they are queueing
+                if self.scraper.reddit.limiter.expected_wait() > 0:
+                    logger.info("Reddit rate limit busy, cutting cache warm-up short")
+                    return
+
+                posts = await self.scraper.reddit.get_listing(
+                    subreddit, filter_type, CACHE_WARM_LISTING_SIZE, time_range
+                )
+                self.scraper.listing_cache.set(
+                    subreddit,
+                    filter_type,
+                    time_range,
+                    CACHE_WARM_LISTING_SIZE,
+                    posts,
+                    # Top listings stay cached until the next pass
+                    min_ttl=self.interval + CACHE_WARM_TTL_MARGIN,
+                )
+
+                if not self.scraper.media_cache.enabled:
+                    continue
+                for post in posts[: self.media_posts]:
+                    if post.name in warmed:
+                        continue
+                    warmed.add(post.name)
+                    await self.warm_post(post)
+
+        logger.info(
+            "Cache warm-up done: %d post(s) prepared, media cache %s",
+            len(warmed),
+            self.scraper.media_cache.stats(),
+        )
+
+    # Prepare the post the same way a scrape would, storing its media in
+    # the media cache, then throw the prepared messages away
+    async def warm_post(self, post):
+        token = log_config.post_id.set(post.name)
+        try:
+            messages = await self.scraper.get_post_content(post, cache=True)
+        finally:
+            log_config.post_id.reset(token)
+        for message in messages:
+            message.cleanup()
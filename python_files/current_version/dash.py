@@ -0,0 +1,112 @@
+import re
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urljoin
+
+# Codecs that can be stream-copied into an mp4 Discord plays inline
+COPYABLE_VIDEO_CODECS = ("avc1",)
+COPYABLE_AUDIO_CODECS = ("mp4a",)
+
+DURATION_PATTERN = re.compile(
+    r"P(?:(?P<days>[\d.]+)D)?"
+    r"(?:T(?:(?P<hours>[\d.]+)H)?(?:(?P<minutes>[\d.]+)M)?(?:(?P<seconds>[\d.]+)S)?)?"
+)
+
+
+# A single track in a DASH manifest
+class Rendition:
+    def __init__(self, url, bandwidth, codecs, height=None):
+        self.url = url
+        self.bandwidth = bandwidth
+        self.codecs = codecs
+        self.height = height
+
+    # Expected size in bytes for a stream of the given length
+    def estimated_size(self, duration):
+        return int(self.bandwidth * duration / 8)
+
+
+# Convert an ISO 8601 duration such as "PT1M5.5S" into seconds
+def parse_duration(value):
+    match = DURATION_PATTERN.fullmatch(value or "")
+    if not match:
+        return None
+    parts = {key: float(amount or 0) for key, amount in match.groupdict().items()}
+    return (
+        parts["days"] * 86400
+        + parts["hours"] * 3600
+        + parts["minutes"] * 60
+        + parts["seconds"]
+    )
+
+
+def local_name(element):
+    return element.tag.rpartition("}")[2]
+
+
+# Parse a DASH manifest into (duration, video renditions, audio renditions).
+# Renditions whose codecs can't be stream-copied are left out.
+def parse_manifest(manifest_xml, manifest_url):
+    root = ElementTree.fromstring(manifest_xml)
+    duration = parse_duration(root.get("mediaPresentationDuration"))
+    videos = []
+    audios = []
+
+    for adaptation_set in root.iter():
+        if local_name(adaptation_set) != "AdaptationSet":
+            continue
+
+        for representation in adaptation_set:
+            if local_name(representation) != "Representation":
+                continue
+
+            mime_type = representation.get("mimeType") or adaptation_set.get(
+                "mimeType", ""
+            )
+            content_type = adaptation_set.get("contentType") or mime_type.split("/")[0]
+            codecs = representation.get("codecs") or adaptation_set.get("codecs", "")
+            base_url = next(
+                (
+                    child.text.strip()
+                    for child in representation
+                    if local_name(child) == "BaseURL" and child.text
+                ),
+                None,
+            )
+            bandwidth = representation.get("bandwidth")
+            if not base_url or not bandwidth:
+                continue
+
+            rendition = Rendition(
+                urljoin(manifest_url, base_url),
+                int(bandwidth),
+                codecs,
+                int(representation.get("height", 0)) or None,
+            )
+            if content_type == "video" and codecs.startswith(COPYABLE_VIDEO_CODECS):
+                videos.append(rendition)
+            elif content_type == "audio" and codecs.startswith(COPYABLE_AUDIO_CODECS):
+                audios.append(rendition)
+
+    return duration, videos, audios
+
+
+# Pick the best video and audio renditions whose combined size fits the
+# budget. Returns (video, audio) where audio may be None for silent clips,
+# or None if nothing fits.
+def select_renditions(duration, videos, audios, size_budget):
+    if not duration or not videos:
+        return None
+
+    videos = sorted(videos, key=lambda rendition: rendition.bandwidth, reverse=True)
+    audios = sorted(audios, key=lambda rendition: rendition.bandwidth, reverse=True)
+
+    for video in videos:
+        video_size = video.estimated_size(duration)
+        if not audios:
+            if video_size <= size_budget:
+                return video, None
+            continue
+        for audio in audios:
+            if video_size + audio.estimated_size(duration) <= size_budget:
+                return video, audio
+    return None
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+from collections import deque
+from metrics import STAGE_SECONDS
+from prepared_message import PreparedMessage
+
+DISCORD_MESSAGE_LIMIT = 2000  # characters
+MAX_ATTACHMENTS_PER_MESSAGE = 10
+DISCORD_UPLOAD_LIMIT = 25 * 1024 * 1024  # 25MB per message
+# Combine several small posts from one request into a single message
+BATCH_POSTS = os.getenv("BATCH_POSTS", "true").lower() != "false"
+# Discord allows about 5 messages per 5 seconds in a single channel
+CHANNEL_SEND_RATE = 5
+CHANNEL_SEND_PERIOD = 5.0  # seconds
+
+
+# Whether two messages can be sent as one without breaking Discord's limits
+def can_merge(first, second, max_bytes=DISCORD_UPLOAD_LIMIT):
+    content_length = len(first.content) + len(second.content) + 2
+    attachments = first.attachments + second.attachments
+    return (
+        content_length <= DISCORD_MESSAGE_LIMIT
+        and len(attachments) <= MAX_ATTACHMENTS_PER_MESSAGE
+        and sum(attachment.size for attachment in attachments) <= max_bytes
+    )
+
+
+# Kind of media a message carries, for metrics labels. A batch of posts
+# is labelled by its heaviest attachment.
+def media_type(message):
+    extensions = {
+        os.path.splitext(attachment.filename)[1].lower()
+        for attachment in message.attachments
+    }
+    if ".mp4" in extensions:
+        return "video"
+    elif ".gif" in extensions:
+        return "gif"
+    elif extensions:
+        return "image"
+    return "text"
+
+
+def merge(first, second):
+    content = "\n\n".join(part for part in (first.content, second.content) if part)
+    return PreparedMessage(content, first.attachments + second.attachments)
+
+
+# Serializes outgoing messages per channel and paces them to stay inside
+# Discord's per-channel message bucket. Each channel drains independently,
+# so one busy channel never holds up another. Consecutive text-only
+# messages waiting for the same channel are merged into one send.
+class OutboundQueue:
+    def __init__(self, rate=CHANNEL_SEND_RATE, period=CHANNEL_SEND_PERIOD):
+        self.rate = rate
+        self.period = period
+        self.pending = {}
+        self.workers = {}
+        self.sent_at = {}
+
+    # Queue a message and wait until it has been sent. Returns the number
+    # of API calls it cost: 0 if it was merged into an earlier message.
+    async def send(self, channel, content=None, files=None):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(channel.id, deque()).append((content, files, future))
+        if channel.id not in self.workers:
+            self.workers[channel.id] = asyncio.create_task(self.drain(channel))
+        return await future
+
+    def depth(self, channel_id):
+        return len(self.pending.get(channel_id, ()))
+
+    def depths(self):
+        return {channel_id: len(queue) for channel_id, queue in self.pending.items()}
+
+    def total_depth(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    async def drain(self, channel):
+        pending = self.pending[channel.id]
+        sent_at = self.sent_at.setdefault(channel.id, deque())
+        try:
+            while pending:
+                content, files, future = pending.popleft()
+                if future.done():
+                    continue  # the caller gave up waiting
+
+                merged = [future]
+                while not files and content and pending:
+                    next_content, next_files, next_future = pending[0]
+                    if next_future.done():
+                        pending.popleft()
+                        continue
+                    if next_files or not next_content:
+                        break
+                    if len(content) + len(next_content) + 1 > DISCORD_MESSAGE_LIMIT:
+                        break
+                    pending.popleft()
+                    content = f"{content}\n{next_content}"
+                    merged.append(next_future)
+
+                await self.wait_for_slot(sent_at)
+                try:
+                    await channel.send(content=content, files=files)
+                except Exception as e:
+                    for waiting in merged:
+                        if not waiting.done():
+                            waiting.set_exception(e)
+                    continue
+
+                for index, waiting in enumerate(merged):
+                    if not waiting.done():
+                        waiting.set_result(1 if index == 0 else 0)
+        finally:
+            del self.workers[channel.id]
+            if not pending:
+                del self.pending[channel.id]
+
+    # Wait until the channel's bucket has room for another message
+    async def wait_for_slot(self, sent_at):
+        now = time.monotonic()
+        while sent_at and sent_at[0] <= now - self.period:
+            sent_at.popleft()
+        if len(sent_at) >= self.rate:
+            await asyncio.sleep(sent_at[0] + self.period - now)
+            sent_at.popleft()
+        sent_at.append(time.monotonic())
+
+
+# Sends a request's messages to one channel, putting each caption and its
+# attachments in the same API call and batching small posts together.
+# Counts the Discord API calls made for the request.
+class ChannelDelivery:
+    def __init__(self, channel, outbound, batch=BATCH_POSTS):
+        self.channel = channel
+        self.outbound = outbound
+        self.batch = batch
+        self.pending = None
+        self.api_calls = 0
+        self.messages_sent = 0
+
+    async def add(self, message):
+        if not self.batch:
+            await self.send(message)
+        elif self.pending is None:
+            self.pending = message
+        elif can_merge(self.pending, message):
+            self.pending = merge(self.pending, message)
+        else:
+            await self.flush()
+            self.pending = message
+
+    async def flush(self):
+        if self.pending is not None:
+            message = self.pending
+            self.pending = None
+            await self.send(message)
+
+    async def send(self, message):
+        files = message.discord_files()
+        try:
+            if message.content or files:
+                # Includes time spent waiting for the channel's send bucket
+                with STAGE_SECONDS.time(stage="upload", media_type=media_type(message)):
+                    self.api_calls += await self.outbound.send(
+                        self.channel,
+                        content=message.content or None,
+                        files=files or None,
+                    )
+                self.messages_sent += 1
+        finally:
+            for file in files:
+                file.close()
+            message.cleanup()
+
+    # Release anything still waiting to be sent
+    def discard(self):
+        if self.pending is not None:
+            self.pending.cleanup()
+            self.pending = None
@@ -1,22 +1,57 @@
+import aiohttp
+import asyncio
 import discord
+import logging
+import os
+import time
 import requests
 from discord import app_commands
 from discord.ext import commands
-from reddit_api import check_subreddit_exists
+from cache_warmer import CacheWarmer
+from jobs import JobQueue, ScrapeJob
+from log_config import setup_logging
+from metrics import METRICS_PORT, STAGE_SECONDS, MetricsServer, register_state
+from reddit_client import RedditClient
+from subscriptions import SubscriptionPoller, SubscriptionStore
 from web_scraper import WebScraper
 
 # Constants for dropdown menu options
 FILTER_TYPES = ["hot", "new", "top", "rising"]
 TIME_RANGES = ["hour", "day", "week", "month", "year", "all"]
-NUM_POSTS = [1, 2, 3, 4, 5]
+NUM_POSTS = [1, 2, 3, 4, 5, 10, 25, 50]
+# Most posts a single scrape may request
+MAX_POSTS = int(os.getenv("MAX_POSTS", 50))
+
+logger = logging.getLogger(__name__)
 
 
 class ScraperBot:
-    def __init__(self, token, webhook, reddit_headers):
+    # shard_count/shard_ids run only the given shards of a sharded bot,
+    # auto_shard lets Discord pick the shard count for a single process.
+    # metrics_port is where /metrics is served, 0 to turn it off.
+    def __init__(
+        self,
+        token,
+        webhook,
+        reddit_tokens,
+        shard_ids=None,
+        shard_count=None,
+        auto_shard=False,
+        metrics_port=METRICS_PORT,
+    ):
         self.token = token
         self.webhook = webhook
-        self.reddit_headers = reddit_headers
-        self.bot = discord.Client(intents=discord.Intents.default())
+        self.reddit_tokens = reddit_tokens
+        self.shard_ids = shard_ids
+        intents = discord.Intents.default()
+        if shard_count:
+            self.bot = discord.AutoShardedClient(
+                intents=intents, shard_ids=shard_ids, shard_count=shard_count
+            )
+        elif auto_shard:
+            self.bot = discord.AutoShardedClient(intents=intents)
+        else:
+            self.bot = discord.Client(intents=intents)
         self.tree = app_commands.CommandTree(self.bot)
         self.subreddits = {
             1: "memes",
@@ -25,7 +60,23 @@ class ScraperBot:
             4: "dankmemes",
             5: "pics",
         }
-        self.scraper = WebScraper(self.reddit_headers)
+        self.reddit = RedditClient(self.reddit_tokens)
+        self.reddit.remember_subreddits(self.subreddits.values())
+        self.scraper = WebScraper(self.reddit)
+        self.jobs = JobQueue(self.run_scrape_job)
+        self.warmer = CacheWarmer(self.scraper, self.subreddits.values())
+        self.subscriptions = SubscriptionStore()
+        # Each shard process polls for the channels it can see
+        poller_name = (
+            "default"
+            if shard_ids is None
+            else "shards-" + "-".join(str(shard_id) for shard_id in shard_ids)
+        )
+        self.poller = SubscriptionPoller(
+            self.bot, self.scraper, self.subscriptions, poller_name
+        )
+        self.metrics = MetricsServer(metrics_port)
+        register_state(self.scraper, self.jobs)
         self.setup_bot_commands()
 
     def setup_bot_commands(self):
@@ -40,17 +91,14 @@ class ScraperBot:
             if subreddit_number in self.subreddits:
                 subreddit_url = self.subreddits[subreddit_number]
 
-                # Limit the number of posts to scrape, between 1 and 5
-                if num_posts > 5:
-                    num_posts = 5
+                # Limit the number of posts to scrape, between 1 and MAX_POSTS
+                if num_posts > MAX_POSTS:
+                    num_posts = MAX_POSTS
                 elif num_posts < 1:
                     num_posts = 1
 
                 await interaction.response.defer()
-                await interaction.followup.send(
-                    f"Starting to scrape {num_posts} posts from: r/{subreddit_url}"
-                )
-                await self.scraper.scrape_subreddit(
+                await self.enqueue_scrape(
                     interaction, subreddit_url, num_posts, filter_type, time_range
                 )
             else:
@@ -79,29 +127,111 @@ class ScraperBot:
             filter_type: str = "hot",
             time_range: str = None,
         ):
-            subreddit_exists = check_subreddit_exists(
-                subreddit_name, self.reddit_headers
-            )
+            # Defer straight away so the existence check can't run past
+            # the interaction timeout; cached answers return immediately.
+            await interaction.response.defer()
+            try:
+                subreddit_exists = await self.reddit.subreddit_exists(subreddit_name)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Could not check r/%s: %s", subreddit_name, e)
+                await interaction.followup.send(f"An error occurred: {e}")
+                return
             if subreddit_exists:
 
-                # Limit the number of posts to scrape, between 1 and 5
-                if num_posts > 5:
-                    num_posts = 5
+                # Limit the number of posts to scrape, between 1 and MAX_POSTS
+                if num_posts > MAX_POSTS:
+                    num_posts = MAX_POSTS
                 elif num_posts < 1:
                     num_posts = 1
 
-                await interaction.response.defer()
+                await self.enqueue_scrape(
+                    interaction, subreddit_name, num_posts, filter_type, time_range
+                )
+            else:
                 await interaction.followup.send(
-                    f"Starting to scrape {num_posts} posts from: r/{subreddit_name}"
+                    "Invalid subreddit name. Community not found. Please provide a valid subreddit name."
                 )
-                await self.scraper.scrape_subreddit(
-                    interaction, subreddit_name, num_posts, filter_type, time_range
+
+        @self.tree.command(
+            name="queue", description="Show your queued scrape jobs"
+        )
+        async def queue_command(interaction: discord.Interaction):
+            queued, running = self.jobs.jobs_for_user(
+                interaction.guild_id, interaction.user.id
+            )
+            lines = [f"Running: r/{job.subreddit} (job {job.id})" for job in running]
+            for job in queued:
+                position = self.jobs.position(job)
+                lines.append(
+                    f"Queued: r/{job.subreddit} (job {job.id}), position {position}, "
+                    f"starts in about {self.jobs.eta(position):.0f}s"
+                )
+            if not lines:
+                lines.append("You have no scrape jobs queued.")
+            lines.append(
+                f"{self.jobs.depth()} job(s) waiting, {len(self.jobs.running)} running."
+            )
+            await interaction.response.send_message("\n".join(lines))
+
+        @self.tree.command(
+            name="subscribe", description="Post new posts from a subreddit in this channel"
+        )
+        @app_commands.default_permissions(manage_channels=True)
+        async def subscribe_command(
+            interaction: discord.Interaction, subreddit_name: str
+        ):
+            await interaction.response.defer()
+            subreddit_name = subreddit_name.removeprefix("r/").lower()
+            try:
+                subreddit_exists = await self.reddit.subreddit_exists(subreddit_name)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Could not check r/%s: %s", subreddit_name, e)
+                await interaction.followup.send(f"An error occurred: {e}")
+                return
+            if not subreddit_exists:
+                await interaction.followup.send(
+                    "Invalid subreddit name. Community not found. Please provide a valid subreddit name."
+                )
+                return
+
+            if self.subscriptions.add(
+                interaction.channel_id, interaction.guild_id, subreddit_name
+            ):
+                await interaction.followup.send(
+                    f"Subscribed this channel to r/{subreddit_name}. New posts will be posted here as they arrive."
+                )
+            else:
+                await interaction.followup.send(
+                    f"This channel is already subscribed to r/{subreddit_name}."
+                )
+
+        @self.tree.command(
+            name="unsubscribe", description="Stop posting a subreddit in this channel"
+        )
+        @app_commands.default_permissions(manage_channels=True)
+        async def unsubscribe_command(
+            interaction: discord.Interaction, subreddit_name: str
+        ):
+            subreddit_name = subreddit_name.removeprefix("r/").lower()
+            if self.subscriptions.remove(interaction.channel_id, subreddit_name):
+                await interaction.response.send_message(
+                    f"Unsubscribed this channel from r/{subreddit_name}."
                 )
             else:
                 await interaction.response.send_message(
-                    "Invalid subreddit name. Community not found. Please provide a valid subreddit name."
+                    f"This channel isn't subscribed to r/{subreddit_name}."
                 )
 
+        @unsubscribe_command.autocomplete("subreddit_name")
+        async def subscribed_subreddit_autocomplete(
+            interaction: discord.Interaction, current: str
+        ):
+            return [
+                app_commands.Choice(name=subreddit, value=subreddit)
+                for subreddit in self.subscriptions.for_channel(interaction.channel_id)
+                if current.lower() in subreddit
+            ][:25]
+
         @scrape_custom_command.autocomplete("filter_type")
         async def filter_type_autocomplete(
             interaction: discord.Interaction, current: str
@@ -129,7 +259,7 @@ class ScraperBot:
             return [
                 app_commands.Choice(name=str(n), value=n)
                 for n in NUM_POSTS
-                if current in str(n)
+                if n <= MAX_POSTS and current in str(n)
             ]
 
         @scrape_command.autocomplete("subreddit_number")
@@ -169,16 +299,65 @@ class ScraperBot:
             return [ 
                 app_commands.Choice(name=str(n), value=n)
                 for n in NUM_POSTS
-                if current in str(n)
+                if n <= MAX_POSTS and current in str(n)
             ]
 
+    # Queue a scrape for the job workers and let the user know where it stands.
+    # The interaction must already be deferred.
+    async def enqueue_scrape(
+        self, interaction, subreddit, num_posts, filter_type, time_range
+    ):
+        if self.jobs.full():
+            await interaction.followup.send(
+                "The scrape queue is full right now, please try again in a few minutes."
+            )
+            return
+
+        job = ScrapeJob(interaction, subreddit, num_posts, filter_type, time_range)
+        position = self.jobs.submit(job)
+        eta = self.jobs.eta(position)
+        if eta > 0:
+            await interaction.followup.send(
+                f"Queued scrape of {num_posts} posts from r/{subreddit} "
+                f"(position {position}, starts in about {eta:.0f}s). Use /queue to check on it."
+            )
+
+    async def run_scrape_job(self, job):
+        STAGE_SECONDS.observe(
+            time.monotonic() - job.enqueued_at, stage="queue", media_type="none"
+        )
+        if job.expired():
+            # The followup token is gone, so tell the channel directly
+            logger.warning("Dropping scrape job %d, it waited too long", job.id)
+            try:
+                await job.interaction.channel.send(
+                    f"Sorry, the scrape of r/{job.subreddit} waited too long in the queue "
+                    "and was cancelled. Please run the command again."
+                )
+            except discord.HTTPException as e:
+                logger.warning("Could not notify channel of dropped job: %s", e)
+            return
+
+        with STAGE_SECONDS.time(stage="job", media_type="none"):
+            await self.scraper.notify(
+                job.interaction,
+                f"Starting to scrape {job.num_posts} posts from: r/{job.subreddit}",
+            )
+            await self.scraper.scrape_subreddit(
+                job.interaction,
+                job.subreddit,
+                job.num_posts,
+                job.filter_type,
+                job.time_range,
+            )
+
     # async commands
     async def sync_commands(self):
         try:
             synced = await self.tree.sync()
-            print(f"Synced {len(synced)} command(s)")
-        except Exception as e:
-            print(f"Failed to sync commands: {e}")
+            logger.info("Synced %d command(s)", len(synced))
+        except Exception:
+            logger.exception("Failed to sync commands")
 
     """ # async guild commands
     async def sync_commands(self):
@@ -186,17 +365,26 @@ class ScraperBot:
             # Specify a guild ID for faster syncing during development
             guild = discord.Object(id="730835327908053152")
             synced = await self.tree.sync(guild=guild)
-            print(f"Synced {len(synced)} command(s) in the guild.")
-        except Exception as e:
-            print(f"Failed to sync commands: {e}")"""
+            logger.info("Synced %d command(s) in the guild.", len(synced))
+        except Exception:
+            logger.exception("Failed to sync commands")"""
 
     def run(self):
         @self.bot.event
         async def on_ready():
-            await self.sync_commands()
-            print(f"{self.bot.user} has connected to Discord!")
-            print(f"Bot is active in {len(self.bot.guilds)} servers.")
-            print("Ready to receive commands!")
+            # Commands are global, so only the process running shard 0 syncs
+            # them. It also warms the caches: other shard processes on the
+            # host share the media cache through its directory, and the
+            # listing cache when CACHE_BACKEND is "sqlite".
+            if self.shard_ids is None or 0 in self.shard_ids:
+                await self.sync_commands()
+                self.warmer.start()
+            self.poller.start()
+            logger.info("%s has connected to Discord!", self.bot.user)
+            if self.shard_ids is not None:
+                logger.info("Running shards %s", self.shard_ids)
+            logger.info("Bot is active in %d servers.", len(self.bot.guilds))
+            logger.info("Ready to receive commands!")
 
             # Send a call to the webhook that the bot is ready
             try:
@@ -205,6 +393,27 @@ class ScraperBot:
                 }
                 requests.post(self.webhook, json=webhook_message)
             except Exception as e:
-                print(f"Error sending message to webhook: {e}")
+                logger.warning("Error sending message to webhook: %s", e)
+
+        asyncio.run(self.start())
 
-        self.bot.run(self.token)
+    # Open the scraper's shared resources, then connect to Discord.
+    # Everything is released again once the client disconnects.
+    async def start(self):
+        setup_logging()
+        async with self.bot:
+            await self.reddit_tokens.start()
+            await self.reddit.start()
+            await self.scraper.start()
+            await self.metrics.start()
+            self.jobs.start()
+            try:
+                await self.bot.start(self.token)
+            finally:
+                await self.metrics.stop()
+                await self.poller.stop()
+                await self.warmer.stop()
+                await self.jobs.stop()
+                await self.scraper.close()
+                await self.reddit.close()
+                await self.reddit_tokens.close()
@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+import log_config
+
+# Number of scrape jobs that run at the same time
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+# Starting guess for how long a job takes, until real jobs have been timed
+DEFAULT_JOB_SECONDS = 20.0
+# Weight of the latest job when updating the average duration
+DURATION_SMOOTHING = 0.2
+# Most jobs that may wait at once; further commands are turned away
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", 100))
+# Interaction followups stop working 15 minutes after the command, so a
+# job that waited longer than this can't report back through them
+FOLLOWUP_EXPIRY = 14 * 60  # seconds
+
+job_ids = itertools.count(1)
+
+logger = logging.getLogger(__name__)
+
+
+# A scrape requested by a slash command, waiting for a worker
+class ScrapeJob:
+    def __init__(self, interaction, subreddit, num_posts, filter_type, time_range):
+        self.id = next(job_ids)
+        self.interaction = interaction
+        self.guild_id = interaction.guild_id
+        self.user_id = interaction.user.id
+        self.subreddit = subreddit
+        self.num_posts = num_posts
+        self.filter_type = filter_type
+        self.time_range = time_range
+        self.created_at = interaction.created_at
+        self.enqueued_at = time.monotonic()
+
+    # Whether the interaction's followup token has (nearly) run out
+    def expired(self):
+        age = datetime.now(timezone.utc) - self.created_at
+        return age.total_seconds() > FOLLOWUP_EXPIRY
+
+
+# Runs scrape jobs on a fixed pool of async workers. Jobs are queued per
+# guild and the guilds take turns, so one busy server can't starve others.
+class JobQueue:
+    def __init__(self, run_job, workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS):
+        self.run_job = run_job
+        self.worker_count = max(1, workers)
+        self.max_queued = max_queued
+        self.queues = OrderedDict()
+        self.queued = asyncio.Semaphore(0)
+        self.running = {}
+        self.workers = []
+        self.average_duration = DEFAULT_JOB_SECONDS
+
+    def start(self):
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self.worker()) for _ in range(self.worker_count)
+            ]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    # Add a job and return its position in the queue (1 = next to run)
+    def submit(self, job):
+        self.queues.setdefault(job.guild_id, deque()).append(job)
+        self.queued.release()
+        return self.position(job)
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def full(self):
+        return self.depth() >= self.max_queued
+
+    # Where a queued job sits in the round-robin dispatch order
+    def position(self, job):
+        queue = self.queues.get(job.guild_id)
+        if queue is None or job not in queue:
+            return None
+
+        index = queue.index(job)
+        ahead = 0
+        for guild_id, other in self.queues.items():
+            if guild_id == job.guild_id:
+                break
+            ahead += min(len(other), index + 1)
+        for guild_id, other in reversed(self.queues.items()):
+            if guild_id == job.guild_id:
+                break
+            ahead += min(len(other), index)
+        return ahead + index + 1
+
+    # Estimated seconds until a job at the given position starts
+    def eta(self, position):
+        free_workers = self.worker_count - len(self.running)
+        if position <= free_workers:
+            return 0
+        rounds = math.ceil((position - free_workers) / self.worker_count)
+        return rounds * self.average_duration
+
+    def jobs_for_user(self, guild_id, user_id):
+        queued = [job for job in self.queues.get(guild_id, ()) if job.user_id == user_id]
+        running = [
+            job
+            for job in self.running.values()
+            if job.guild_id == guild_id and job.user_id == user_id
+        ]
+        return queued, running
+
+    def next_job(self):
+        guild_id, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        # Send the guild to the back of the line for its next job
+        del self.queues[guild_id]
+        if queue:
+            self.queues[guild_id] = queue
+        return job
+
+    async def worker(self):
+        while True:
+            await self.queued.acquire()
+            job = self.next_job()
+            self.running[job.id] = job
+            started_at = time.monotonic()
+            # Everything logged while the job runs carries its id
+            token = log_config.job_id.set(job.id)
+            try:
+                await self.run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Scrape job %d failed", job.id)
+            finally:
+                log_config.job_id.reset(token)
+                del self.running[job.id]
+                self.average_duration += DURATION_SMOOTHING * (
+                    time.monotonic() - started_at - self.average_duration
+                )
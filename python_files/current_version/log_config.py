@@ -0,0 +1,65 @@
+import contextvars
+import json
+import logging
+import os
+
+# Level for the bot's own loggers and discord.py, e.g. DEBUG, INFO or WARNING.
+# Full post payloads are only logged at DEBUG.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "text" for readable lines, "json" for one JSON object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+
+TEXT_FORMAT = "[{asctime}] [{levelname:<8}] {name}: [job={job_id} post={post_id}] {message}"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Correlation ids for the scrape job and post being handled. Tasks copy the
+# context they are created in, so work spawned for a job or post carries
+# its ids into every record it logs.
+job_id = contextvars.ContextVar("job_id", default="-")
+post_id = contextvars.ContextVar("post_id", default="-")
+
+
+# Stamps every record with the current correlation ids
+class CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        record.job_id = job_id.get()
+        record.post_id = post_id.get()
+        return True
+
+
+# The handler setup_logging installs, recognisable so it is only added once
+class CorrelationHandler(logging.StreamHandler):
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.addFilter(CorrelationFilter())
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "job_id": record.job_id,
+            "post_id": record.post_id,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Send every logger, discord.py's included, to stderr in the configured
+# format. Safe to call more than once.
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    root = logging.getLogger()
+    if any(isinstance(handler, CorrelationHandler) for handler in root.handlers):
+        return
+
+    handler = CorrelationHandler()
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT, style="{"))
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level, logging.INFO))
@@ -1,13 +1,131 @@
-from env_config import load_env_variables
-from reddit_api import get_reddit_access_token
-from discord_bot import ScraperBot
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reddit scraper Discord bot")
+    parser.add_argument(
+        "--shard-processes",
+        type=int,
+        default=int(os.getenv("SHARD_PROCESSES", 1)),
+        help="Number of processes the bot's shards are split across",
+    )
+    parser.add_argument(
+        "--shard-process",
+        type=int,
+        default=None,
+        help="Index of this process (0-based). Without it, all shard processes are launched from here.",
+    )
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=int(os.getenv("SHARD_COUNT", 0)),
+        help="Total number of shards (defaults to one per process)",
+    )
+    parser.add_argument(
+        "--auto-shard",
+        action="store_true",
+        help="Run every shard in this process with the shard count Discord recommends",
+    )
+    return parser.parse_args()
+
+
+# Split the shards into contiguous ranges, one per process
+def shard_ids_for_process(process_index, process_count, shard_count):
+    per_process, remainder = divmod(shard_count, process_count)
+    start = process_index * per_process + min(process_index, remainder)
+    end = start + per_process + (1 if process_index < remainder else 0)
+    return list(range(start, end))
+
+
+# Seconds a shard process gets to exit after SIGTERM before it is killed
+SHUTDOWN_TIMEOUT = 30
+
+
+# Stop the parent on SIGTERM (supervisord, docker stop) the same way as on
+# Ctrl+C, so its shard processes are stopped with it
+def handle_sigterm(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+# Start one child process per shard range and wait for all of them.
+# Caches are shared between the processes through the SQLite backend.
+# The children are stopped whenever the parent stops. Returns the exit
+# status for the parent: non-zero if any child failed.
+def launch_shard_processes(args):
+    env = dict(os.environ, CACHE_BACKEND=os.getenv("CACHE_BACKEND", "sqlite"))
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--shard-processes",
+                str(args.shard_processes),
+                "--shard-process",
+                str(index),
+                "--shard-count",
+                str(args.shard_count),
+            ],
+            env=env,
+        )
+        for index in range(args.shard_processes)
+    ]
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # A repeated SIGTERM must not cut the shutdown short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    failed = False
+    for index, process in enumerate(processes):
+        if process.returncode != 0:
+            logger.error(
+                "Shard process %d exited with code %d", index, process.returncode
+            )
+            failed = True
+    return 1 if failed else 0
+
 
 if __name__ == "__main__":
-    env_vars = load_env_variables()
+    args = parse_args()
+    args.shard_count = args.shard_count or args.shard_processes
 
-    print(env_vars)
+    if args.shard_processes > 1 and args.shard_process is None:
+        setup_logging()
+        sys.exit(launch_shard_processes(args))
 
-    reddit_access_token = get_reddit_access_token(
+    from env_config import load_env_variables
+    from reddit_api import RedditTokenManager
+    from discord_bot import ScraperBot
+    from metrics import METRICS_PORT
+
+    setup_logging()
+    env_vars = load_env_variables()
+    # Only the names: the values are credentials
+    logger.debug("Loaded settings: %s", ", ".join(sorted(env_vars)))
+
+    # The token is fetched when the bot starts and refreshed in the background
+    reddit_tokens = RedditTokenManager(
         env_vars["REDDIT_CLIENT_ID"],
         env_vars["REDDIT_CLIENT_SECRET"],
         env_vars["REDDIT_USERNAME"],
@@ -15,16 +133,25 @@ if __name__ == "__main__":
         env_vars["REDDIT_USER_AGENT"],
     )
 
-    print(reddit_access_token)
+    shard_ids = None
+    shard_count = None
+    metrics_port = METRICS_PORT
+    if args.shard_process is not None:
+        # Each shard process serves its metrics on its own port
+        if metrics_port:
+            metrics_port += args.shard_process
+        shard_count = args.shard_count
+        shard_ids = shard_ids_for_process(
+            args.shard_process, args.shard_processes, shard_count
+        )
 
-    headers = {
-        "Authorization": f"bearer {reddit_access_token}",
-        "User-Agent": env_vars["REDDIT_USER_AGENT"],
-        "Content-Type": "application/json",
-        "X-Requested-With": "XMLHttpRequest",
-    }
-
-    print(headers)
-
-    bot = ScraperBot(env_vars["DISCORD_TOKEN"], env_vars["WEBHOOK"], headers)
+    bot = ScraperBot(
+        env_vars["DISCORD_TOKEN"],
+        env_vars["WEBHOOK"],
+        reddit_tokens,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        auto_shard=args.auto_shard,
+        metrics_port=metrics_port,
+    )
     bot.run()
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from prepared_message import Attachment, MEDIA_MEMORY_LIMIT, copy_to_temp
+
+MEDIA_CACHE_DIR = os.getenv(
+    "MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "scraper-media")
+)
+# Disk space the cached media may use. Set to 0 to turn the cache off.
+MEDIA_CACHE_BUDGET = int(os.getenv("MEDIA_CACHE_BUDGET_MB", 1024)) * 1024 * 1024
+# Index of the cached files, kept in the cache directory. The leading dot
+# keeps it (and its -wal/-shm files) out of the media file scan.
+INDEX_NAME = ".index.sqlite3"
+
+
+# Downloaded and transcoded media kept on local disk, keyed by source URL,
+# so media that was already prepared once is not fetched or encoded again.
+# The least recently used files are removed once the disk budget is spent.
+# Files are indexed in SQLite next to them, so every process using the
+# same directory sees the same files and shares one budget.
+class MediaCache:
+    def __init__(self, directory=MEDIA_CACHE_DIR, budget=MEDIA_CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.connection = None
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(
+                os.path.join(directory, INDEX_NAME), timeout=5, isolation_level=None
+            )
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "name TEXT PRIMARY KEY, size INTEGER NOT NULL, used_at REAL NOT NULL)"
+            )
+            self.load()
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    # Index files left by an earlier run that aren't indexed yet, and drop
+    # index entries whose file is gone
+    def load(self):
+        indexed = {
+            row[0] for row in self.connection.execute("SELECT name FROM files")
+        }
+        on_disk = set()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            on_disk.add(name)
+            if name not in indexed:
+                stat = os.stat(path)
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO files VALUES (?, ?, ?)",
+                    (name, stat.st_size, stat.st_mtime),
+                )
+        self.connection.executemany(
+            "DELETE FROM files WHERE name = ?",
+            [(name,) for name in indexed - on_disk],
+        )
+        self.evict()
+
+    def name(self, url):
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    # Return a copy of the cached file for url as an attachment, or None.
+    # The copy belongs to the caller, so eviction never removes a file
+    # that is still waiting to be uploaded.
+    async def attachment(self, url, filename):
+        if not self.enabled:
+            return None
+
+        name = self.name(url)
+        row = self.connection.execute(
+            "SELECT size FROM files WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        try:
+            attachment = await asyncio.to_thread(self.read, name, filename, row[0])
+        except FileNotFoundError:
+            # Evicted, possibly by another process, since the lookup
+            self.forget(name)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute(
+            "UPDATE files SET used_at = ? WHERE name = ?", (time.time(), name)
+        )
+        return attachment
+
+    # Runs in a worker thread so disk reads don't block the event loop
+    def read(self, name, filename, size):
+        path = os.path.join(self.directory, name)
+        if size <= MEDIA_MEMORY_LIMIT:
+            with open(path, "rb") as file:
+                return Attachment(filename, data=file.read())
+        return Attachment(filename, path=copy_to_temp(path, filename))
+
+    # Keep a copy of a prepared attachment under its source URL
+    async def store(self, url, attachment):
+        if not self.enabled or attachment.size > self.budget:
+            return
+
+        name = self.name(url)
+        await asyncio.to_thread(self.write, name, attachment)
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+            (name, attachment.size, time.time()),
+        )
+        self.evict()
+
+    # Runs in a worker thread so disk writes don't block the event loop
+    def write(self, name, attachment):
+        path = os.path.join(self.directory, name)
+        # Write under a temporary name first so other processes sharing
+        # the directory never see a partial file
+        partial = os.path.join(self.directory, f".{name}.{os.getpid()}")
+        if attachment.data is not None:
+            with open(partial, "wb") as file:
+                file.write(attachment.data)
+        else:
+            shutil.copyfile(attachment.path, partial)
+        os.replace(partial, path)
+
+    def forget(self, name):
+        self.connection.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def total_size(self):
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM files"
+        ).fetchone()[0]
+
+    # Remove the least recently used files until the cache fits its budget
+    def evict(self):
+        excess = self.total_size() - self.budget
+        if excess <= 0:
+            return
+
+        for name, size in self.connection.execute(
+            "SELECT name, size FROM files ORDER BY used_at"
+        ).fetchall():
+            if excess <= 0:
+                break
+            self.forget(name)
+            excess -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        stats = {"files": 0, "bytes": 0, "hits": self.hits, "misses": self.misses}
+        if self.enabled:
+            files, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files"
+            ).fetchone()
+            stats.update(files=files, bytes=size)
+        return stats
@@ -0,0 +1,61 @@
+import asyncio
+import aiohttp
+import logging
+from transcoder import target_video_bitrate
+
+logger = logging.getLogger(__name__)
+
+# How a post's media can be delivered
+UPLOADABLE = "upload"
+NEEDS_TRANSCODE = "transcode"
+LINK_ONLY = "link"
+
+PROBE_TIMEOUT = 10  # seconds
+
+
+# Works out how a post's media will be delivered before anything is
+# downloaded, so media that can only be linked is never fetched
+class MediaProbe:
+    def __init__(self, session, size_limit):
+        self.session = session
+        self.size_limit = size_limit
+
+    # Size of a remote file from a HEAD request, falling back to a one-byte
+    # range request. Returns None when the server doesn't say.
+    async def remote_size(self, url):
+        timeout = aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+        try:
+            async with self.session.head(
+                url, allow_redirects=True, timeout=timeout
+            ) as response:
+                content_length = response.headers.get("Content-Length")
+                if response.status < 400 and content_length:
+                    return int(content_length)
+
+            async with self.session.get(
+                url, headers={"Range": "bytes=0-0"}, timeout=timeout
+            ) as response:
+                if response.status == 206:
+                    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                    if total.isdigit():
+                        return int(total)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning("Could not probe %s: %s", url, e)
+        return None
+
+    # Images, gifs and direct video files are uploaded as they are
+    async def classify_file(self, url):
+        size = await self.remote_size(url)
+        if size is not None and size > self.size_limit:
+            return LINK_ONLY
+        return UPLOADABLE
+
+    # Reddit-hosted videos always go through ffmpeg. The listing already
+    # carries the duration, which is enough to rule out videos that can't
+    # fit the size limit at any acceptable bitrate.
+    def classify_reddit_video(self, reddit_video, size_budget=True):
+        duration = reddit_video.duration
+        if size_budget and duration:
+            if target_video_bitrate(duration, self.size_limit) is None:
+                return LINK_ONLY
+        return NEEDS_TRANSCODE
@@ -0,0 +1,251 @@
+import bisect
+import logging
+import os
+import time
+from aiohttp import web
+
+# Local port the Prometheus endpoint listens on. Set to 0 to turn it off.
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Seconds; covers everything from a cached listing to a full transcode
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+logger = logging.getLogger(__name__)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+# A monotonically increasing value per label combination
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+
+# A value read when the endpoint is scraped, e.g. a queue depth, or a
+# counter kept elsewhere (kind="counter"). read() returns a number, or a
+# dict mapping tuples of label values to numbers.
+class Gauge:
+    def __init__(self, name, description, read, labels=(), kind="gauge"):
+        self.name = name
+        self.description = description
+        self.read = read
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield self.name, format_labels(self.labels, key), value
+
+
+# Observations counted into cumulative buckets per label combination
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0, 0.0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += 1
+        series[2] += value
+
+    # Time the enclosed block, e.g. "with STAGE_SECONDS.time(stage="download"):"
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for key, (counts, count, total) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", format_labels(names, key + (bound,)), cumulative
+            yield f"{self.name}_bucket", format_labels(names, key + ("+Inf",)), count
+            yield f"{self.name}_count", format_labels(self.labels, key), count
+            yield f"{self.name}_sum", format_labels(self.labels, key), total
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.started_at, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    # Render every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                samples = list(metric.samples())
+            except Exception:
+                logger.exception("Could not collect metric %s", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "scraper_stage_seconds",
+        "Time spent in each stage of a scrape",
+        ("stage", "media_type"),
+    )
+)
+DOWNLOADED_BYTES = REGISTRY.register(
+    Counter(
+        "scraper_downloaded_bytes_total",
+        "Bytes of media downloaded",
+        ("media_type",),
+    )
+)
+TRANSCODE_SECONDS = REGISTRY.register(
+    Counter(
+        "scraper_transcode_seconds_total",
+        "Seconds ffmpeg spent converting videos",
+    )
+)
+
+
+# Register gauges reading the bot's live state. Called once the objects
+# they read exist.
+def register_state(scraper, jobs):
+    REGISTRY.register(
+        Gauge(
+            "scraper_cache_hits_total",
+            "Cache lookups answered from the cache",
+            lambda: {
+                ("listing",): scraper.listing_cache.stats()["hits"],
+                ("media",): scraper.media_cache.hits,
+            },
+            ("cache",),
+            kind="counter",
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "scraper_cache_misses_total",
+            "Cache lookups that had to fetch",
+            lambda: {
+                ("listing",): scraper.listing_cache.stats()["misses"],
+                ("media",): scraper.media_cache.misses,
+            },
+            ("cache",),
+            kind="counter",
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "scraper_queue_depth",
+            "Work waiting in each queue",
+            lambda: {
+                ("jobs",): jobs.depth(),
+                ("outbound",): scraper.outbound.total_depth(),
+                ("ffmpeg",): scraper.transcoder.waiting,
+            },
+            ("queue",),
+        )
+    )
+    REGISTRY.register(
+        Gauge(
+            "scraper_active",
+            "Work currently running",
+            lambda: {
+                ("jobs",): len(jobs.running),
+                ("ffmpeg",): scraper.transcoder.active,
+            },
+            ("kind",),
+        )
+    )
+
+
+# Serves /metrics from the bot's own event loop
+class MetricsServer:
+    def __init__(self, port=METRICS_PORT, host=METRICS_HOST, registry=REGISTRY):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self.runner = None
+
+    async def start(self):
+        if self.port <= 0 or self.runner is not None:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError as e:
+            # Metrics are optional; never keep the bot from starting
+            logger.warning("Could not serve metrics on port %d: %s", self.port, e)
+            await self.stop()
+            return
+        logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request):
+        return web.Response(
+            text=self.registry.render(), content_type="text/plain", charset="utf-8"
+        )
@@ -0,0 +1,200 @@
+import html
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+GIF_EXTENSIONS = (".gif",)
+
+
+# The parts of a Reddit-hosted video the pipeline needs
+class RedditVideo:
+    __slots__ = ("fallback_url", "hls_url", "dash_url", "duration")
+
+    def __init__(self, fallback_url, hls_url, dash_url=None, duration=None):
+        self.fallback_url = fallback_url
+        self.hls_url = hls_url
+        self.dash_url = dash_url
+        self.duration = duration
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(
+            data.get("fallback_url"),
+            data.get("hls_url"),
+            data.get("dash_url"),
+            data.get("duration"),
+        )
+
+    def to_dict(self):
+        return {
+            "fallback_url": self.fallback_url,
+            "hls_url": self.hls_url,
+            "dash_url": self.dash_url,
+            "duration": self.duration,
+        }
+
+
+# One image or video in a gallery post
+class GalleryItem:
+    __slots__ = ("media_id", "mime_type")
+
+    def __init__(self, media_id, mime_type):
+        self.media_id = media_id
+        self.mime_type = mime_type
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["media_id"], data["mime_type"])
+
+    def to_dict(self):
+        return {"media_id": self.media_id, "mime_type": self.mime_type}
+
+
+# A listing entry reduced to the fields the scraper uses. Built once when
+# a listing is parsed, so the full JSON for each post isn't kept around.
+class Post:
+    __slots__ = (
+        "name",
+        "crosspost_parent",
+        "title",
+        "permalink",
+        "url",
+        "over_18",
+        "created_utc",
+        "is_gallery",
+        "video",
+        "gallery",
+        "preview_variants",
+    )
+
+    def __init__(
+        self,
+        name,
+        title,
+        permalink,
+        url,
+        over_18=False,
+        created_utc=None,
+        crosspost_parent=None,
+        is_gallery=False,
+        video=None,
+        gallery=None,
+        preview_variants=None,
+    ):
+        self.name = name
+        self.crosspost_parent = crosspost_parent
+        self.title = title
+        self.permalink = permalink
+        self.url = url
+        self.over_18 = over_18
+        self.created_utc = created_utc
+        self.is_gallery = is_gallery
+        self.video = video
+        self.gallery = gallery or []
+        self.preview_variants = preview_variants or {}
+
+    # Build a Post from a listing child ({"kind": "t3", "data": {...}}).
+    # Returns None for entries without post data.
+    @classmethod
+    def from_listing(cls, child):
+        data = child.get("data")
+        if not data:
+            return None
+
+        media = data.get("media") or {}
+        video = None
+        if "reddit_video" in media:
+            video = RedditVideo.from_data(media["reddit_video"])
+
+        media_metadata = data.get("media_metadata") or {}
+        gallery = [
+            GalleryItem(
+                item["media_id"], media_metadata.get(item["media_id"], {}).get("m", "")
+            )
+            for item in (data.get("gallery_data") or {}).get("items", [])
+            if item.get("media_id")
+        ]
+
+        # Source URL of each preview variant, e.g. the mp4 rendering of a gif
+        images = (data.get("preview") or {}).get("images") or [{}]
+        preview_variants = {
+            variant: html.unescape(source["source"]["url"])
+            for variant, source in images[0].get("variants", {}).items()
+            if "source" in source
+        }
+
+        return cls(
+            data.get("name"),
+            data.get("title"),
+            data.get("permalink"),
+            data.get("url") or "",
+            data.get("over_18", False),
+            data.get("created_utc"),
+            data.get("crosspost_parent"),
+            data.get("is_gallery", False),
+            video,
+            gallery,
+            preview_variants,
+        )
+
+    # Plain JSON-compatible form, for caches shared between processes
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "title": self.title,
+            "permalink": self.permalink,
+            "url": self.url,
+            "over_18": self.over_18,
+            "created_utc": self.created_utc,
+            "crosspost_parent": self.crosspost_parent,
+            "is_gallery": self.is_gallery,
+            "video": self.video.to_dict() if self.video else None,
+            "gallery": [item.to_dict() for item in self.gallery],
+            "preview_variants": self.preview_variants,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        video = data.get("video")
+        return cls(
+            data["name"],
+            data["title"],
+            data["permalink"],
+            data["url"],
+            data.get("over_18", False),
+            data.get("created_utc"),
+            data.get("crosspost_parent"),
+            data.get("is_gallery", False),
+            RedditVideo.from_data(video) if video else None,
+            [GalleryItem.from_dict(item) for item in data.get("gallery", [])],
+            data.get("preview_variants"),
+        )
+
+    @property
+    def image_url(self):
+        return self.url if self.url.endswith(IMAGE_EXTENSIONS) else None
+
+    @property
+    def gif_url(self):
+        return self.url if self.url.endswith(GIF_EXTENSIONS) else None
+
+    # Whether the post has a gallery, video, image or gif that can be delivered
+    @property
+    def has_media(self):
+        return bool(
+            self.is_gallery or self.video or self.image_url or self.gif_url
+        )
+
+    # Kind of media the post carries, for metrics labels
+    @property
+    def media_type(self):
+        if self.is_gallery:
+            return "gallery"
+        elif self.video:
+            return "video"
+        elif self.gif_url:
+            return "gif"
+        elif self.image_url:
+            return "image"
+        return "none"
+
+    def __repr__(self):
+        return f"Post({self.name!r}, {self.title!r}, {self.url!r})"
@@ -0,0 +1,119 @@
+import io
+import os
+import shutil
+import tempfile
+import discord
+
+# Attachments larger than this are spilled to a temporary file instead of
+# being held in memory. Set to 0 to always write attachments to disk.
+MEDIA_MEMORY_LIMIT = int(os.getenv("MEDIA_MEMORY_LIMIT", 8 * 1024 * 1024))
+
+
+# A single file to upload, held either in memory or in a temporary file
+class Attachment:
+    def __init__(self, filename, data=None, path=None):
+        self.filename = filename
+        self.data = data
+        self.path = path
+
+    @property
+    def size(self):
+        if self.data is not None:
+            return len(self.data)
+        return os.path.getsize(self.path)
+
+    # An independent attachment with the same contents, which can be
+    # uploaded and cleaned up separately
+    def copy(self):
+        if self.data is not None:
+            return Attachment(self.filename, data=self.data)
+        return Attachment(self.filename, path=copy_to_temp(self.path, self.filename))
+
+    def to_discord_file(self):
+        if self.data is not None:
+            return discord.File(io.BytesIO(self.data), filename=self.filename)
+        return discord.File(self.path, filename=self.filename)
+
+    def cleanup(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self.data = None
+
+
+# Create a uniquely named temporary file for a job and return its path
+def unique_temp_path(suffix):
+    fd, path = tempfile.mkstemp(prefix="scraper-", suffix=suffix)
+    os.close(fd)
+    return path
+
+
+# Copy a file to a new temporary path, hard linking it where possible
+def copy_to_temp(path, filename):
+    copy = unique_temp_path(os.path.splitext(filename)[1])
+    os.remove(copy)
+    try:
+        os.link(path, copy)
+    except OSError:
+        shutil.copyfile(path, copy)
+    return copy
+
+
+# Collects streamed chunks in memory, switching to a temporary file once
+# the body grows past MEDIA_MEMORY_LIMIT
+class AttachmentBuffer:
+    def __init__(self, filename, memory_limit=MEDIA_MEMORY_LIMIT):
+        self.filename = filename
+        self.memory_limit = memory_limit
+        self.buffer = bytearray()
+        self.file = None
+        self.path = None
+
+    def write(self, chunk):
+        if self.file is None and len(self.buffer) + len(chunk) > self.memory_limit:
+            self.path = unique_temp_path(os.path.splitext(self.filename)[1])
+            self.file = open(self.path, "wb")
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.buffer.extend(chunk)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+            return Attachment(self.filename, path=self.path)
+        return Attachment(self.filename, data=bytes(self.buffer))
+
+    # Discard whatever was written so far
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.path)
+        self.buffer = bytearray()
+
+
+# A post that has been downloaded and processed, waiting to be sent to Discord
+class PreparedMessage:
+    def __init__(self, content, attachments=None):
+        self.content = content
+        self.attachments = attachments or []
+
+    def copy(self):
+        return PreparedMessage(
+            self.content, [attachment.copy() for attachment in self.attachments]
+        )
+
+    def discord_files(self):
+        return [attachment.to_discord_file() for attachment in self.attachments]
+
+    # Release any buffers or temporary files held for this message
+    def cleanup(self):
+        for attachment in self.attachments:
+            attachment.cleanup()
+        self.attachments = []
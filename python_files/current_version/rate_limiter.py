@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+# Reddit allows roughly 100 requests per minute per OAuth client. These are
+# only used until the first response tells us the real numbers.
+DEFAULT_REQUESTS = 100
+DEFAULT_WINDOW = 60
+# Most requests that may go out back to back before pacing kicks in
+BURST = 10
+# Requests held back from each window as a safety margin
+RESERVE = 2
+
+
+# Token bucket shared by every Reddit-bound request. The refill rate follows
+# the X-Ratelimit-Remaining/X-Ratelimit-Reset headers, so the remaining quota
+# is spread over the rest of the window instead of being burned at once.
+class RateLimiter:
+    def __init__(self, burst=BURST, reserve=RESERVE):
+        self.burst = burst
+        self.reserve = reserve
+        self.rate = (DEFAULT_REQUESTS - reserve) / DEFAULT_WINDOW
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.waiting = 0
+        self.lock = asyncio.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Seconds a request made now would wait before being sent
+    def expected_wait(self):
+        now = time.monotonic()
+        self.refill(now)
+        blocked = max(self.blocked_until - now, 0)
+        deficit = self.waiting + 1 - self.tokens
+        if deficit <= 0:
+            return blocked
+        if self.rate <= 0:
+            return max(blocked, DEFAULT_WINDOW)
+        return blocked + deficit / self.rate
+
+    # Wait for a free slot. Waiters are served in arrival order.
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    if self.blocked_until > now:
+                        await asyncio.sleep(self.blocked_until - now)
+                        continue
+
+                    self.refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    if self.rate > 0:
+                        await asyncio.sleep((1 - self.tokens) / self.rate)
+                    else:
+                        await asyncio.sleep(DEFAULT_WINDOW)
+        finally:
+            self.waiting -= 1
+
+    # Adapt to the quota Reddit reports on every response
+    def update(self, headers, status=200):
+        now = time.monotonic()
+        try:
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset = float(headers["X-Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            remaining = reset = None
+
+        if status == 429:
+            retry_after = headers.get("Retry-After")
+            try:
+                delay = float(retry_after) if retry_after else reset
+            except ValueError:
+                delay = reset
+            self.blocked_until = now + (delay or DEFAULT_WINDOW)
+            self.tokens = 0
+            self.updated_at = now
+            return
+
+        if remaining is None:
+            return
+
+        self.refill(now)
+        usable = remaining - self.reserve
+        if usable <= 0:
+            # Quota spent: hold everything until the window resets
+            self.blocked_until = now + reset
+            self.tokens = 0
+            self.rate = DEFAULT_REQUESTS / max(reset, DEFAULT_WINDOW)
+        else:
+            self.rate = usable / max(reset, 1)
+            self.tokens = min(self.tokens, usable)
@@ -1,35 +1,109 @@
-import requests
-
-
-def get_reddit_access_token(client_id, client_secret, username, password, user_agent):
-    auth = requests.auth.HTTPBasicAuth(client_id, client_secret)
-    data = {
-        "grant_type": "password",
-        "username": username,
-        "password": password,
-    }
-    headers = {"User-Agent": user_agent}
-
-    response = requests.post(
-        "https://www.reddit.com/api/v1/access_token",
-        auth=auth,
-        data=data,
-        headers=headers,
-    )
-    response.raise_for_status()
-    token = response.json().get("access_token")
-    if not token:
-        raise KeyError("Access token not found in response.")
-    return token
-
-
-def check_subreddit_exists(subreddit_name, headers):
-    response = requests.get(
-        f"https://oauth.reddit.com/r/{subreddit_name}/about", headers=headers
-    )
-    if response.status_code == 200:
-        return True
-    elif response.status_code == 404:
-        return False
-    else:
-        response.raise_for_status()
+import asyncio
+import logging
+import time
+import aiohttp
+
+ACCESS_TOKEN_URL = "https://www.reddit.com/api/v1/access_token"
+
+# Refresh this many seconds before the token actually expires
+REFRESH_MARGIN = 5 * 60
+# Wait this long before retrying a failed background refresh
+REFRESH_RETRY_DELAY = 30
+
+logger = logging.getLogger(__name__)
+
+
+# Holds the Reddit OAuth token, refreshing it in the background before it
+# expires. Concurrent refresh requests share a single token request.
+class RedditTokenManager:
+    def __init__(self, client_id, client_secret, username, password, user_agent):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.username = username
+        self.password = password
+        self.user_agent = user_agent
+        self.access_token = None
+        self.expires_at = 0
+        self.session = None
+        self.refreshing = None
+        self.refresh_loop_task = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        await self.refresh()
+        if self.refresh_loop_task is None:
+            self.refresh_loop_task = asyncio.create_task(self.refresh_loop())
+
+    async def close(self):
+        if self.refresh_loop_task is not None:
+            self.refresh_loop_task.cancel()
+            self.refresh_loop_task = None
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def get_headers(self):
+        if self.access_token is None or time.monotonic() >= self.expires_at:
+            await self.refresh()
+
+        return {
+            "Authorization": f"bearer {self.access_token}",
+            "User-Agent": self.user_agent,
+            "Content-Type": "application/json",
+            "X-Requested-With": "XMLHttpRequest",
+        }
+
+    # Force the next get_headers() call to fetch a new token,
+    # e.g. after Reddit rejected the current one with a 401
+    def invalidate(self):
+        self.expires_at = 0
+
+    async def refresh(self):
+        task = self.refreshing
+        if task is None:
+            task = self.refreshing = asyncio.create_task(self.fetch_token())
+        try:
+            await asyncio.shield(task)
+        finally:
+            if self.refreshing is task and task.done():
+                self.refreshing = None
+
+    async def fetch_token(self):
+        data = {
+            "grant_type": "password",
+            "username": self.username,
+            "password": self.password,
+        }
+        async with self.session.post(
+            ACCESS_TOKEN_URL,
+            auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+            data=data,
+            headers={"User-Agent": self.user_agent},
+        ) as response:
+            response.raise_for_status()
+            token_data = await response.json()
+
+        token = token_data.get("access_token")
+        if not token:
+            raise KeyError("Access token not found in response.")
+
+        self.access_token = token
+        self.expires_at = time.monotonic() + token_data.get("expires_in", 3600)
+        logger.info(
+            "Refreshed Reddit access token, expires in %ss",
+            token_data.get("expires_in", 3600),
+        )
+
+    async def refresh_loop(self):
+        while True:
+            delay = self.expires_at - REFRESH_MARGIN - time.monotonic()
+            await asyncio.sleep(max(delay, REFRESH_RETRY_DELAY))
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Timeouts, bad responses and anything else: retry later
+                # rather than ending the loop for good
+                logger.warning("Failed to refresh Reddit access token: %r", e)
@@ -0,0 +1,129 @@
+import aiohttp
+from cache import make_cache
+from metrics import STAGE_SECONDS
+from post import Post
+from rate_limiter import RateLimiter
+
+REDDIT_API_URL = "https://oauth.reddit.com"
+
+# Connection pool settings for the Reddit API session
+MAX_CONNECTIONS = 20
+KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept open
+DNS_CACHE_TTL = 300  # seconds a resolved host is cached
+REQUEST_TIMEOUT = 30  # seconds before a listing request is abandoned
+MAX_ATTEMPTS = 3  # tries per request when Reddit answers 401 or 429
+
+# How long subreddit existence checks are remembered
+EXISTS_TTL = 6 * 60 * 60
+NOT_FOUND_TTL = 10 * 60  # not found, private or banned
+EXISTS_CACHE_SIZE = 1024
+
+
+class RedditClient:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.session = None
+        self.limiter = RateLimiter()
+        self.exists_cache = make_cache("subreddit_exists", EXISTS_CACHE_SIZE)
+
+    # Create the pooled session shared by every Reddit API call
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=MAX_CONNECTIONS,
+                limit_per_host=MAX_CONNECTIONS,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            )
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def build_listing_url(
+        self, subreddit, filter_type, limit, time_range=None, after=None, before=None
+    ):
+        # Default to hot if filter type is not provided, or if it's invalid
+        if filter_type in ["top", "controversial"]:
+            url = f"{REDDIT_API_URL}/r/{subreddit}/{filter_type}?limit={limit}&t={time_range}"
+        elif filter_type in ["hot", "new", "rising"]:
+            url = f"{REDDIT_API_URL}/r/{subreddit}/{filter_type}?limit={limit}"
+        else:
+            url = f"{REDDIT_API_URL}/r/{subreddit}/hot?limit={limit}"
+
+        # Continue the listing after, or only return posts newer than,
+        # the given post fullname
+        if after:
+            url += f"&after={after}"
+        if before:
+            url += f"&before={before}"
+        return url
+
+    # Send a GET request with the current OAuth headers once the rate
+    # limiter allows it. A rejected token is refreshed and a 429 is
+    # retried after the wait Reddit asked for.
+    async def request(self, url, **kwargs):
+        token_refreshed = False
+        for attempt in range(MAX_ATTEMPTS):
+            await self.limiter.acquire()
+            headers = await self.tokens.get_headers()
+            response = await self.session.get(url, headers=headers, **kwargs)
+            self.limiter.update(response.headers, response.status)
+
+            last_attempt = attempt == MAX_ATTEMPTS - 1
+            if response.status == 401 and not token_refreshed and not last_attempt:
+                response.release()
+                self.tokens.invalidate()
+                token_refreshed = True
+            elif response.status == 429 and not last_attempt:
+                response.release()
+            else:
+                return response
+
+    # Fetch a subreddit listing and return its posts, parsed into Post
+    # objects. Raises aiohttp.ClientResponseError on a non-2xx response.
+    async def get_listing(
+        self, subreddit, filter_type, limit, time_range=None, after=None, before=None
+    ):
+        url = self.build_listing_url(
+            subreddit, filter_type, limit, time_range, after, before
+        )
+        with STAGE_SECONDS.time(stage="listing", media_type="none"):
+            async with await self.request(url) as response:
+                response.raise_for_status()
+                listing = await response.json()
+        children = listing.get("data", {}).get("children", [])
+        posts = [Post.from_listing(child) for child in children]
+        return [post for post in posts if post is not None]
+
+    # Mark subreddits as known to exist, e.g. the bot's preset list
+    def remember_subreddits(self, subreddit_names):
+        for subreddit_name in subreddit_names:
+            self.exists_cache.set(subreddit_name.lower(), True, EXISTS_TTL)
+
+    async def subreddit_exists(self, subreddit_name):
+        key = subreddit_name.lower()
+        exists = self.exists_cache.get(key)
+        if exists is None:
+            exists = await self.fetch_subreddit_exists(subreddit_name)
+            self.exists_cache.set(key, exists, EXISTS_TTL if exists else NOT_FOUND_TTL)
+        return exists
+
+    async def fetch_subreddit_exists(self, subreddit_name):
+        # Reddit redirects unknown subreddits to the search page, so
+        # redirects are treated the same as a 404. Private and banned
+        # subreddits answer 403 and can't be scraped either.
+        async with await self.request(
+            f"{REDDIT_API_URL}/r/{subreddit_name}/about", allow_redirects=False
+        ) as response:
+            if response.status == 200:
+                return True
+            elif response.status in (301, 302, 403, 404):
+                return False
+            else:
+                response.raise_for_status()
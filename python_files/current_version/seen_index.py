@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import time
+
+SEEN_INDEX_PATH = os.getenv("SEEN_INDEX_PATH", "seen_posts.sqlite3")
+# How long a delivered post is remembered for a channel
+SEEN_RETENTION_DAYS = float(os.getenv("SEEN_RETENTION_DAYS", 30))
+PRUNE_INTERVAL = 60 * 60  # seconds between retention sweeps
+
+
+# Which posts have already been delivered to which channel, kept in SQLite
+# so it survives restarts. Posts are tracked by fullname (t3_...), and a
+# crosspost counts as seen when its parent was delivered and vice versa.
+class SeenIndex:
+    def __init__(self, path=SEEN_INDEX_PATH, retention_days=SEEN_RETENTION_DAYS):
+        self.retention = retention_days * 24 * 60 * 60
+        self.last_pruned = 0
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            "channel_id INTEGER NOT NULL, post_id TEXT NOT NULL, seen_at REAL NOT NULL, "
+            "PRIMARY KEY (channel_id, post_id)) WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS seen_at_index ON seen (seen_at)"
+        )
+
+    # Every id a post is known by: its own fullname and its crosspost parent
+    def post_ids(self, post):
+        ids = [post.name, post.crosspost_parent]
+        return [post_id for post_id in ids if post_id]
+
+    # Return the posts that haven't been delivered to the channel yet
+    def unseen(self, channel_id, posts):
+        ids = {post_id for post in posts for post_id in self.post_ids(post)}
+        if not ids:
+            return list(posts)
+
+        placeholders = ",".join("?" * len(ids))
+        seen = {
+            row[0]
+            for row in self.connection.execute(
+                f"SELECT post_id FROM seen WHERE channel_id = ? AND post_id IN ({placeholders})",
+                (channel_id, *ids),
+            )
+        }
+        return [
+            post
+            for post in posts
+            if not any(post_id in seen for post_id in self.post_ids(post))
+        ]
+
+    def mark_seen(self, channel_id, posts):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO seen VALUES (?, ?, ?)",
+            [
+                (channel_id, post_id, now)
+                for post in posts
+                for post_id in self.post_ids(post)
+            ],
+        )
+        if now - self.last_pruned > PRUNE_INTERVAL:
+            self.prune(now)
+
+    # Forget posts older than the retention window
+    def prune(self, now=None):
+        now = now or time.time()
+        self.connection.execute(
+            "DELETE FROM seen WHERE seen_at < ?", (now - self.retention,)
+        )
+        self.last_pruned = now
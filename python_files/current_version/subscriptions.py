@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import defaultdict
+import log_config
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTIONS_PATH = os.getenv("SUBSCRIPTIONS_PATH", "subscriptions.sqlite3")
+# Seconds between polls of every subscribed subreddit
+SUBSCRIPTION_POLL_INTERVAL = int(os.getenv("SUBSCRIPTION_POLL_INTERVAL", 120))
+# New posts fetched per subreddit per poll; any backlog carries over
+SUBSCRIPTION_POLL_LIMIT = 10
+# A before cursor stops returning anything if its post is removed, so a
+# quiet subreddit's cursor is checked against the plain listing this often
+CURSOR_CHECK_INTERVAL = 60 * 60  # seconds
+
+
+# Which channels follow which subreddits, and the newest post each poller
+# has seen per subreddit, kept in SQLite so both survive restarts
+class SubscriptionStore:
+    def __init__(self, path=SUBSCRIPTIONS_PATH):
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions ("
+            "channel_id INTEGER NOT NULL, subreddit TEXT NOT NULL, "
+            "guild_id INTEGER, created_at REAL NOT NULL, "
+            "PRIMARY KEY (channel_id, subreddit))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS subscriptions_subreddit "
+            "ON subscriptions (subreddit)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cursors ("
+            "poller TEXT NOT NULL, subreddit TEXT NOT NULL, "
+            "post_id TEXT NOT NULL, created_utc REAL NOT NULL, "
+            "PRIMARY KEY (poller, subreddit))"
+        )
+
+    # Returns False if the channel was already subscribed
+    def add(self, channel_id, guild_id, subreddit):
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO subscriptions VALUES (?, ?, ?, ?)",
+            (channel_id, subreddit.lower(), guild_id, time.time()),
+        )
+        return cursor.rowcount > 0
+
+    # Returns False if the channel wasn't subscribed
+    def remove(self, channel_id, subreddit):
+        cursor = self.connection.execute(
+            "DELETE FROM subscriptions WHERE channel_id = ? AND subreddit = ?",
+            (channel_id, subreddit.lower()),
+        )
+        return cursor.rowcount > 0
+
+    def for_channel(self, channel_id):
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT subreddit FROM subscriptions WHERE channel_id = ? "
+                "ORDER BY subreddit",
+                (channel_id,),
+            )
+        ]
+
+    # Map each subscribed subreddit to the channel ids following it
+    def channels_by_subreddit(self):
+        channels = defaultdict(list)
+        for subreddit, channel_id in self.connection.execute(
+            "SELECT subreddit, channel_id FROM subscriptions"
+        ):
+            channels[subreddit].append(channel_id)
+        return channels
+
+    def cursor(self, poller, subreddit):
+        return self.connection.execute(
+            "SELECT post_id, created_utc FROM cursors "
+            "WHERE poller = ? AND subreddit = ?",
+            (poller, subreddit),
+        ).fetchone()
+
+    def set_cursor(self, poller, subreddit, post_id, created_utc):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)",
+            (poller, subreddit, post_id, created_utc),
+        )
+
+
+# Polls /new once per subscribed subreddit, however many channels follow
+# it, and hands the new posts to every one of those channels. Only posts
+# newer than the last one seen are requested, using Reddit's before cursor.
+class SubscriptionPoller:
+    # name keeps the cursors of pollers in different shard processes apart,
+    # since each process only delivers to the channels it can see
+    def __init__(
+        self, bot, scraper, store, name="default", interval=SUBSCRIPTION_POLL_INTERVAL
+    ):
+        self.bot = bot
+        self.scraper = scraper
+        self.store = store
+        self.name = name
+        self.interval = interval
+        self.checked_at = {}
+        self.task = None
+
+    # Safe to call again on reconnect; only one poller ever runs
+    def start(self):
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while True:
+            for subreddit, channel_ids in self.store.channels_by_subreddit().items():
+                channels = [
+                    channel
+                    for channel in map(self.bot.get_channel, channel_ids)
+                    if channel is not None
+                ]
+                if not channels:
+                    continue  # followed only from other shards, or deleted
+                log_config.job_id.set(f"poll-{subreddit}")
+                try:
+                    await self.poll(subreddit, channels)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Polling r/%s failed", subreddit)
+            await asyncio.sleep(self.interval)
+
+    async def poll(self, subreddit, channels):
+        cursor = self.store.cursor(self.name, subreddit)
+        if cursor is None:
+            # New subscription: start from the newest post instead of
+            # flooding the channel with the subreddit's backlog
+            posts = await self.new_posts(subreddit, 1)
+            if posts:
+                self.remember(subreddit, posts[0])
+            return
+
+        post_id, created_utc = cursor
+        posts = await self.new_posts(subreddit, SUBSCRIPTION_POLL_LIMIT, before=post_id)
+        now = time.time()
+        if not posts and now - self.checked_at.get(subreddit, 0) > CURSOR_CHECK_INTERVAL:
+            self.checked_at[subreddit] = now
+            posts = [
+                post
+                for post in await self.new_posts(subreddit, SUBSCRIPTION_POLL_LIMIT)
+                if (post.created_utc or 0) > created_utc
+            ]
+        if not posts:
+            return
+
+        # Listings are newest first; deliver in the order they were posted
+        self.remember(subreddit, posts[0])
+        posts = [post for post in posts if post.has_media]
+        if not posts:
+            return
+        logger.info(
+            "%d new post(s) in r/%s for %d channel(s)",
+            len(posts),
+            subreddit,
+            len(channels),
+        )
+        await self.scraper.deliver_to_channels(list(reversed(posts)), channels)
+
+    async def new_posts(self, subreddit, limit, before=None):
+        return await self.scraper.reddit.get_listing(
+            subreddit, "new", limit, before=before
+        )
+
+    def remember(self, subreddit, post):
+        self.store.set_cursor(
+            self.name, subreddit, post.name, post.created_utc or time.time()
+        )
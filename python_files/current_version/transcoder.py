@@ -0,0 +1,253 @@
+import asyncio
+import json
+import os
+import time
+from metrics import STAGE_SECONDS, TRANSCODE_SECONDS
+
+
+def available_cpus():
+    # Respect the container's CPU affinity where the platform exposes it
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Maximum number of ffmpeg processes allowed to run at once
+FFMPEG_MAX_JOBS = int(os.getenv("FFMPEG_MAX_JOBS", available_cpus()))
+FFMPEG_TIMEOUT = 300  # 5-minute timeout per job
+FFPROBE_TIMEOUT = 30
+
+# Codecs Discord can play inline without re-encoding
+DISCORD_VIDEO_CODECS = ["h264"]
+DISCORD_AUDIO_CODECS = ["aac"]
+DISCORD_PIXEL_FORMATS = ["yuv420p", "yuvj420p"]
+
+AUDIO_BITRATE = 128 * 1000
+# Lowest video bitrate worth encoding at; below this we post a link instead
+MIN_VIDEO_BITRATE = int(os.getenv("MIN_VIDEO_BITRATE", 200 * 1000))
+# Share of the size limit the encode aims for, leaving room for the container
+SIZE_BUDGET_MARGIN = 0.95
+
+
+class TranscodeError(Exception):
+    pass
+
+
+# Copy the streams into an mp4 container without re-encoding
+def remux_command(input_url, output_path):
+    return [
+        "ffmpeg",
+        "-y",  # Overwrite the placeholder temp file
+        "-i",
+        input_url,
+        "-c",
+        "copy",
+        "-max_muxing_queue_size",
+        "1024",  # Max demux queue size
+        "-bsf:a",
+        "aac_adtstoasc",
+        "-movflags",
+        "+faststart",  # Put the index first so Discord can start playback early
+        output_path,
+    ]
+
+
+# Combine separate video and audio tracks without re-encoding
+def mux_command(video_url, audio_url, output_path):
+    cmd = ["ffmpeg", "-y", "-i", video_url]
+    if audio_url:
+        cmd += ["-i", audio_url, "-map", "0:v:0", "-map", "1:a:0"]
+    cmd += [
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",  # Put the index first so Discord can start playback early
+        output_path,
+    ]
+    return cmd
+
+
+# Re-encode to H.264/AAC. With max_video_bitrate set, the CRF encode is
+# capped so the output stays within a size budget in a single pass.
+def transcode_command(input_url, output_path, max_video_bitrate=None):
+    cmd = [
+        "ffmpeg",
+        "-y",  # Overwrite the placeholder temp file
+        "-i",
+        input_url,
+        "-c:v",
+        "libx264",  # Video codec
+        "-crf",
+        "25",  # Constant Rate Factor (0-51, lower is better quality)
+        "-preset",
+        "veryfast",  # Preset for encoding speed vs. compression ratio
+    ]
+    if max_video_bitrate:
+        cmd += [
+            "-maxrate",
+            str(max_video_bitrate),
+            "-bufsize",
+            str(max_video_bitrate),  # One second of buffer keeps the cap tight
+        ]
+    cmd += [
+        "-max_muxing_queue_size",
+        "1024",  # Max demux queue size
+        "-c:a",
+        "aac",  # Audio codec
+        "-b:a",
+        str(AUDIO_BITRATE),  # Audio bitrate
+        "-bsf:a",
+        "aac_adtstoasc",
+        output_path,
+    ]
+    return cmd
+
+
+def media_duration(probe_info):
+    try:
+        return float(probe_info["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Expected size in bytes of a stream copy, or None if ffprobe didn't say
+def estimated_size(probe_info):
+    duration = media_duration(probe_info)
+    try:
+        bit_rate = int(probe_info["format"]["bit_rate"])
+    except (KeyError, TypeError, ValueError):
+        bit_rate = sum(
+            int(stream.get("bit_rate", 0))
+            for stream in probe_info.get("streams", [])
+        )
+    if not duration or not bit_rate:
+        return None
+    return int(duration * bit_rate / 8)
+
+
+# Video bitrate that fits a clip of the given duration under size_limit,
+# or None if even MIN_VIDEO_BITRATE would not fit
+def target_video_bitrate(duration, size_limit):
+    total_bitrate = size_limit * 8 * SIZE_BUDGET_MARGIN / duration
+    video_bitrate = int(total_bitrate - AUDIO_BITRATE)
+    if video_bitrate < MIN_VIDEO_BITRATE:
+        return None
+    return video_bitrate
+
+
+# Whether the streams reported by ffprobe can be stream-copied for Discord
+def discord_compatible(probe_info):
+    streams = probe_info.get("streams", [])
+    video = [stream for stream in streams if stream.get("codec_type") == "video"]
+    audio = [stream for stream in streams if stream.get("codec_type") == "audio"]
+    if not video:
+        return False
+    for stream in video:
+        if stream.get("codec_name") not in DISCORD_VIDEO_CODECS:
+            return False
+        if stream.get("pix_fmt", "yuv420p") not in DISCORD_PIXEL_FORMATS:
+            return False
+    for stream in audio:
+        if stream.get("codec_name") not in DISCORD_AUDIO_CODECS:
+            return False
+    return True
+
+
+# Kill a child process that is still running and reap it. The wait is
+# shielded so a second cancellation can't leave a zombie behind.
+async def kill(process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    await asyncio.shield(process.wait())
+
+
+class Transcoder:
+    def __init__(self, max_jobs=FFMPEG_MAX_JOBS):
+        self.max_jobs = max(1, max_jobs)
+        self.semaphore = asyncio.Semaphore(self.max_jobs)
+        self.active = 0
+        self.waiting = 0
+
+    # Run an ffmpeg command once a worker slot is free.
+    # on_queued(position) is awaited if the job has to wait for a slot,
+    # on_start() is awaited once the job actually begins.
+    # Raises asyncio.TimeoutError or TranscodeError on failure.
+    async def run(self, cmd, timeout=FFMPEG_TIMEOUT, on_queued=None, on_start=None):
+        if self.semaphore.locked() and on_queued:
+            await on_queued(self.waiting + 1)
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        started_at = None
+        try:
+            if on_start:
+                await on_start()
+
+            # Timed from here so the on_start followup isn't counted
+            started_at = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except BaseException:
+                # Timed out or cancelled: don't leave ffmpeg running
+                # outside the worker limit
+                await kill(process)
+                raise
+
+            if process.returncode != 0:
+                error = stderr.decode(errors="replace").strip().splitlines()
+                raise TranscodeError(
+                    f"ffmpeg exited with code {process.returncode}: "
+                    f"{error[-1] if error else 'no output'}"
+                )
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+            if started_at is not None:
+                elapsed = time.monotonic() - started_at
+                TRANSCODE_SECONDS.inc(elapsed)
+                STAGE_SECONDS.observe(elapsed, stage="transcode", media_type="video")
+
+    # Read stream and container information with ffprobe.
+    # Probes are cheap, so they don't wait for a transcode slot.
+    async def probe(self, input_url, timeout=FFPROBE_TIMEOUT):
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe",
+            "-v",
+            "error",
+            "-print_format",
+            "json",
+            "-show_streams",
+            "-show_format",
+            input_url,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except BaseException:
+            await kill(process)
+            raise
+
+        if process.returncode != 0:
+            error = stderr.decode(errors="replace").strip().splitlines()
+            raise TranscodeError(
+                f"ffprobe exited with code {process.returncode}: "
+                f"{error[-1] if error else 'no output'}"
+            )
+        return json.loads(stdout or b"{}")
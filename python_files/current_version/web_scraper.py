@@ -1,353 +1,825 @@
-import requests
 import aiohttp
+import asyncio
+import discord
+import logging
 import os
-import subprocess
 import re
-import discord
+import log_config
 from urllib.parse import urljoin, urlparse
+from cache import ListingCache
+from dash import parse_manifest, select_renditions
+from delivery import (
+    DISCORD_UPLOAD_LIMIT,
+    MAX_ATTACHMENTS_PER_MESSAGE,
+    ChannelDelivery,
+    OutboundQueue,
+)
+from media_cache import MediaCache
+from media_probe import LINK_ONLY, MediaProbe
+from metrics import DOWNLOADED_BYTES, STAGE_SECONDS
+from seen_index import SeenIndex
+from prepared_message import (
+    Attachment,
+    AttachmentBuffer,
+    PreparedMessage,
+    unique_temp_path,
+)
+from transcoder import (
+    SIZE_BUDGET_MARGIN,
+    Transcoder,
+    TranscodeError,
+    discord_compatible,
+    estimated_size,
+    media_duration,
+    mux_command,
+    remux_command,
+    target_video_bitrate,
+    transcode_command,
+)
 from utils import sanitize_filename
 
+logger = logging.getLogger(__name__)
+
+# Connection pool settings for the shared media download session
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 20
+KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept open
+DNS_CACHE_TTL = 300  # seconds a resolved host is cached
+
+# Number of posts from one request that are downloaded/processed at once
+POST_CONCURRENCY = int(os.getenv("POST_CONCURRENCY", 3))
+# Send posts in listing order, or as soon as each one is ready
+DELIVER_IN_ORDER = os.getenv("DELIVER_IN_ORDER", "true").lower() != "false"
+
+# How HLS videos are converted: "auto" stream-copies when the codecs are
+# already Discord compatible, "always" and "never" force one path
+VIDEO_REMUX_MODE = os.getenv("VIDEO_REMUX_MODE", "auto").lower()
+# Encode HLS videos to fit the upload limit instead of checking afterwards
+VIDEO_SIZE_BUDGET = os.getenv("VIDEO_SIZE_BUDGET", "true").lower() != "false"
+# Stream-copy the best DASH rendition that fits before falling back to HLS
+VIDEO_DASH_SELECTION = os.getenv("VIDEO_DASH_SELECTION", "true").lower() != "false"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Gallery items downloaded at once for a single post
+GALLERY_CONCURRENCY = int(os.getenv("GALLERY_CONCURRENCY", 4))
+# Skip posts that were already delivered to the channel
+SEEN_INDEX_ENABLED = os.getenv("SEEN_INDEX", "true").lower() != "false"
+# Listing pages are at least this long, so posts skipped for having no
+# media or being seen already rarely cost another request
+LISTING_PAGE_SIZE = 25
+MAX_LISTING_PAGE_SIZE = 100  # the most Reddit returns in one page
+MAX_LISTING_PAGES = 10  # listing pages read per request at most
+
 
 class WebScraper:
-    def __init__(self, headers):
-        self.headers = headers
+    def __init__(self, reddit):
+        self.reddit = reddit
+        self.session = None
+        self.transcoder = Transcoder()
+        self.listing_cache = ListingCache()
+        self.media_probe = None
+        self.outbound = OutboundQueue()
+        self.seen_index = SeenIndex() if SEEN_INDEX_ENABLED else None
+        self.media_cache = MediaCache()
+
+    # Create the long-lived session used for every media download
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=MAX_CONNECTIONS,
+                limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.media_probe = MediaProbe(self.session, DISCORD_UPLOAD_LIMIT)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
 
     async def scrape_subreddit(
-        self, interaction, subreddit_url, num_posts, filter_type, time_range
+        self,
+        interaction,
+        subreddit_url,
+        num_posts,
+        filter_type,
+        time_range,
+        ordered=DELIVER_IN_ORDER,
     ):
-        print(f"Scraping {num_posts} posts from: {subreddit_url}")
+        logger.info("Scraping %d posts from r/%s", num_posts, subreddit_url)
 
-        # Default to hot if filter type is not provided, or if it's invalid
         try:
-            if filter_type in ["top", "controversial"]:
-                response = requests.get(
-                    f"https://oauth.reddit.com/r/{subreddit_url}/{filter_type}?limit={num_posts}&t={time_range}",
-                    headers=self.headers,
-            )
-            elif filter_type in ["hot", "new", "rising"]:
-                response = requests.get(
-                    f"https://oauth.reddit.com/r/{subreddit_url}/{filter_type}?limit={num_posts}",
-                    headers=self.headers,
+            posts = self.iter_posts(
+                subreddit_url, filter_type, time_range, num_posts, interaction
             )
-            else:
-                response = requests.get(
-                    f"https://oauth.reddit.com/r/{subreddit_url}/hot?limit={num_posts}",
-                    headers=self.headers,
+            delivered = await self.deliver_posts(
+                posts, interaction, num_posts, ordered
             )
-            
-            response.raise_for_status()
-
-            if response.status_code == 200:
-                posts = response.json().get("data", {}).get("children", [])
-                for post in posts:
-                    post_data = post.get("data", {})
-                    if post_data:
-                        print("Post data:", post_data)
-                        print("Moving to get_post_content")
-                        await self.get_post_content(post_data, interaction)
-            else:
+            if not delivered:
                 await interaction.followup.send(
-                    f"Failed to fetch posts. Status code: {response.status_code}"
+                    f"No new posts found in r/{subreddit_url} that haven't already been posted here."
                 )
 
-        except requests.exceptions.HTTPError as http_err:
-            await interaction.followup.send(f"HTTP error occurred: {http_err}")
-            print(f"HTTP error occurred: {http_err}")
-        except requests.exceptions.RequestException as e:
-            await interaction.followup.send(f"An error occurred: {e}")
-            print(f"An error occurred: {e}")
+        except aiohttp.ClientResponseError as http_err:
+            await self.notify(interaction, f"HTTP error occurred: {http_err}")
+            logger.warning("HTTP error occurred: %s", http_err)
+        except aiohttp.ClientError as e:
+            await self.notify(interaction, f"An error occurred: {e}")
+            logger.warning("An error occurred: %s", e)
         except Exception as e:
-            print("Error encountered in scrape_subreddit:", e)
-            await interaction.followup.send(f"An unexpected error occurred: {e}")
-
-    async def get_post_content(self, post, interaction=None):
-        try:
-            print("Getting post content for", post.get("url"))
-            title = post.get("title")
-            nsfw = post.get("over_18", False)
-            gallery = post.get("is_gallery", False)
-            perm_url = post.get("permalink")
-            reddit_post_url = urljoin("https://www.reddit.com", perm_url)
-
-            if gallery:
-                await self.process_gallery(post, title, interaction, nsfw)
+            logger.exception("Error encountered in scrape_subreddit")
+            await self.notify(interaction, f"An unexpected error occurred: {e}")
+
+    # Yield the listing's posts page by page, following the after cursor,
+    # skipping posts without media and posts already delivered to the
+    # channel. Each page is only fetched once the previous one is used up.
+    async def iter_posts(
+        self, subreddit, filter_type, time_range, num_posts, interaction=None
+    ):
+        page_limit = min(max(num_posts, LISTING_PAGE_SIZE), MAX_LISTING_PAGE_SIZE)
+        after = None
+        for _ in range(MAX_LISTING_PAGES):
+            if after is None:
+                children = await self.get_listing(
+                    subreddit, filter_type, page_limit, time_range, interaction
+                )
             else:
-                media = post.get("media")
-                video = (
-                    media["reddit_video"]["fallback_url"]
-                    if media and "reddit_video" in media
-                    else None
+                children = await self.reddit.get_listing(
+                    subreddit, filter_type, page_limit, time_range, after=after
                 )
-                hls_video = (
-                    media["reddit_video"]["hls_url"]
-                    if media and "reddit_video" in media
-                    else None
+
+            posts = [post for post in children if post.has_media]
+            if self.seen_index is not None and interaction is not None:
+                posts = self.seen_index.unseen(interaction.channel_id, posts)
+            for post in posts:
+                yield post
+
+            if len(children) < page_limit:
+                return  # the listing has run out
+            after = children[-1].name
+            if not after:
+                return
+            page_limit = MAX_LISTING_PAGE_SIZE
+
+    # Serve the listing from the cache when possible
+    async def get_listing(
+        self, subreddit, filter_type, limit, time_range=None, interaction=None
+    ):
+        posts = self.listing_cache.get(subreddit, filter_type, time_range, limit)
+        if posts is None:
+            wait = self.reddit.limiter.expected_wait()
+            if interaction and wait >= 1:
+                await self.notify(
+                    interaction,
+                    f"Reddit rate limit reached, your request is queued (about {wait:.0f}s)",
                 )
-                image = (
-                    post.get("url")
-                    if post.get("url").endswith((".jpg", ".jpeg", ".png"))
-                    else None
+            posts = await self.reddit.get_listing(
+                subreddit, filter_type, limit, time_range
+            )
+            self.listing_cache.set(subreddit, filter_type, time_range, limit, posts)
+        return posts
+
+    # Deliver up to num_posts posts from an async iterable, preparing them
+    # concurrently (bounded by POST_CONCURRENCY) and sending the results
+    # either in listing order or in the order they finish. Posts are pulled
+    # from the iterable as delivery makes room, so the first ones go out
+    # while later listing pages are still loading, and a post that yields
+    # nothing to send is replaced by the next one. Returns the number of
+    # posts delivered.
+    async def deliver_posts(self, posts, interaction, num_posts, ordered=True):
+        semaphore = asyncio.Semaphore(POST_CONCURRENCY)
+        # Posts taken from the listing but not delivered yet
+        lookahead = asyncio.Semaphore(POST_CONCURRENCY * 2)
+        # Posts still wanted, less those being prepared
+        wanted = asyncio.Semaphore(num_posts)
+        results = asyncio.Queue()
+        tasks = []
+
+        async def prepare(post):
+            async with semaphore:
+                log_config.post_id.set(post.name)
+                logger.debug("Post data: %r", post)
+                with STAGE_SECONDS.time(stage="prepare", media_type=post.media_type):
+                    messages = await self.get_post_content(post, interaction)
+                return post, messages
+
+        async def produce():
+            iterator = aiter(posts)
+            try:
+                while True:
+                    # Wait until another post is needed before pulling one,
+                    # so no listing page is fetched that won't be used
+                    await wanted.acquire()
+                    await lookahead.acquire()
+                    try:
+                        post = await anext(iterator)
+                    except StopAsyncIteration:
+                        break
+                    task = asyncio.create_task(prepare(post))
+                    tasks.append(task)
+                    if ordered:
+                        results.put_nowait(task)
+                    else:
+                        task.add_done_callback(results.put_nowait)
+            finally:
+                if not ordered:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                results.put_nowait(None)
+
+        # check the channel the command was called from,
+        # and send the messages to that channel
+        delivery = ChannelDelivery(interaction.channel, self.outbound)
+        producer = asyncio.create_task(produce())
+        delivered = []
+        try:
+            while len(delivered) < num_posts:
+                task = await results.get()
+                if task is None:
+                    break
+                post, messages = await task
+                for message in messages:
+                    await delivery.add(message)
+                # A post that failed to prepare stays unseen, so a later
+                # scrape can try it again; another post takes its place
+                if messages:
+                    delivered.append(post)
+                else:
+                    wanted.release()
+                lookahead.release()
+            await delivery.flush()
+            if len(delivered) < num_posts:
+                # The listing ran out; surface errors from fetching it
+                await producer
+            logger.info(
+                "Delivered %d post(s) to %s in %d message(s) using %d API call(s)",
+                len(delivered),
+                interaction.channel,
+                delivery.messages_sent,
+                delivery.api_calls,
+            )
+            if self.seen_index is not None:
+                self.seen_index.mark_seen(interaction.channel_id, delivered)
+            return len(delivered)
+        finally:
+            delivery.discard()
+            # If delivery stopped early, stop the remaining work and
+            # remove anything that was prepared but never sent
+            producer.cancel()
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(producer, *tasks, return_exceptions=True)
+            for task in tasks:
+                if not task.cancelled() and not task.exception():
+                    for message in task.result()[1]:
+                        message.cleanup()
+
+    # Prepare each post once and send it to every channel in the list.
+    # A channel that can't be sent to doesn't hold up the others.
+    async def deliver_to_channels(self, posts, channels):
+        deliveries = [ChannelDelivery(channel, self.outbound) for channel in channels]
+        failed = set()
+        delivered = []
+
+        async def add(delivery, message):
+            try:
+                await delivery.add(message)
+            except Exception as e:
+                logger.warning("Could not deliver to %s: %s", delivery.channel, e)
+                failed.add(delivery.channel.id)
+                message.cleanup()
+
+        try:
+            for post in posts:
+                token = log_config.post_id.set(post.name)
+                try:
+                    with STAGE_SECONDS.time(
+                        stage="prepare", media_type=post.media_type
+                    ):
+                        messages = await self.get_post_content(post)
+                finally:
+                    log_config.post_id.reset(token)
+                if messages:
+                    delivered.append(post)
+                try:
+                    for message in messages:
+                        await asyncio.gather(
+                            *(
+                                add(delivery, message.copy())
+                                for delivery in deliveries
+                                if delivery.channel.id not in failed
+                            )
+                        )
+                finally:
+                    for message in messages:
+                        message.cleanup()
+
+            for delivery in deliveries:
+                if delivery.channel.id not in failed:
+                    try:
+                        await delivery.flush()
+                    except Exception as e:
+                        logger.warning("Could not deliver to %s: %s", delivery.channel, e)
+                        failed.add(delivery.channel.id)
+        finally:
+            for delivery in deliveries:
+                delivery.discard()
+
+        if self.seen_index is not None:
+            for channel in channels:
+                if channel.id not in failed:
+                    self.seen_index.mark_seen(channel.id, delivered)
+
+    # Download and process a single post.
+    # Returns the list of messages to send for it (empty if nothing to send).
+    # cache=True also stores the downloaded and converted media in the
+    # media cache; only the cache warmer does this, to keep disk writes
+    # off the path of user scrapes.
+    async def get_post_content(self, post, interaction=None, cache=False):
+        try:
+            logger.info("Getting post content for %s", post.url)
+            title = post.title
+            nsfw = post.over_18
+            reddit_post_url = urljoin("https://www.reddit.com", post.permalink)
+
+            if post.is_gallery:
+                return await self.process_gallery(
+                    post, title, interaction, nsfw, cache
                 )
-                gif = post.get("url") if post.get("url").endswith(".gif") else None
+            else:
+                video = post.video.fallback_url if post.video else None
+                hls_video = post.video.hls_url if post.video else None
+                image = post.image_url
+                gif = post.gif_url
 
                 if hls_video:
                     backup_video = video if video else None
-                    await self.process_video(
-                        hls_video, title, backup_video, interaction, nsfw
+                    delivery = self.media_probe.classify_reddit_video(
+                        post.video, VIDEO_SIZE_BUDGET
                     )
+                    if delivery == LINK_ONLY:
+                        logger.info(
+                            "Video for %s can't fit the upload limit, posting a link",
+                            title,
+                        )
+                        message = PreparedMessage(f"{title}\n{backup_video}")
+                    else:
+                        message = await self.process_video(
+                            hls_video,
+                            title,
+                            backup_video,
+                            interaction,
+                            nsfw,
+                            dash_url=post.video.dash_url,
+                            cache=cache,
+                        )
                 elif video and not image and not gif:
-                    await self.process_video(video, title, interaction, nsfw)
+                    message = await self.link_if_too_large(video, title)
+                    if message is None:
+                        message = await self.process_video(
+                            video, title, video, interaction, nsfw, cache=cache
+                        )
                 elif image and not video and not gif:
-                    await self.process_image(
-                        image, title, reddit_post_url, interaction, nsfw
+                    message = await self.process_image(
+                        image, title, reddit_post_url, interaction, nsfw, cache
                     )
                 elif gif and not image and not video:
-                    await self.process_gif(
-                        gif, title, reddit_post_url, interaction, nsfw
+                    message = await self.process_gif(
+                        gif, title, reddit_post_url, interaction, nsfw, cache
                     )
                 else:
-                    print("No image, video, gif, or gallery found.")
-                    await interaction.followup.send(
-                        f"No image, video, gif, or gallery found for post: {title} ({post.get('url')})"
-                    )
+                    logger.info("No image, video, gif, or gallery found")
+                    if interaction:
+                        await self.notify(
+                            interaction,
+                            f"No image, video, gif, or gallery found for post: {title} ({post.url})",
+                        )
+                    message = None
+
+                return [message] if message else []
 
         except Exception as e:
-            print("Error getting post content:", e)
-            await interaction.followup.send(
-                f"An unexpected error occurred while processing the post: {e}"
-            )
+            logger.exception("Error getting post content")
+            if interaction:
+                await self.notify(
+                    interaction,
+                    f"An unexpected error occurred while processing the post: {e}",
+                )
+            return []
 
-    async def process_gallery(self, post, title, interaction, nsfw):
+    async def process_gallery(self, post, title, interaction, nsfw, cache=False):
         try:
-            print(f"Interaction type: {type(interaction)}, Interaction: {interaction}")
+            items = []
+            for index, item in enumerate(post.gallery, start=1):
+                extension = gallery_extension(item.mime_type)
+                if extension is None:
+                    logger.warning("Unknown media type for %s", item.media_id)
+                    continue
+                url = f"https://i.redd.it/{item.media_id}.{extension}"
+                filename = sanitize_filename(f"{title} {index}.{extension}")
+                items.append((url, filename))
+
+            # Download every item at once, bounded by GALLERY_CONCURRENCY
+            semaphore = asyncio.Semaphore(GALLERY_CONCURRENCY)
+
+            async def download(url, filename):
+                async with semaphore:
+                    return await self.fetch_attachment(
+                        url, filename, "gallery", cache
+                    )
 
-            if not hasattr(interaction, "followup"):
-                raise ValueError(
-                    "The interaction object does not have the expected 'followup' attribute."
-                )
+            results = await asyncio.gather(
+                *(download(url, filename) for url, filename in items),
+                return_exceptions=True,
+            )
 
-            gallery_data = post.get("gallery_data", {}).get("items", [])
-            media_metadata = post.get("media_metadata", {})
-
-            # Process only the first item in the gallery
-            if gallery_data:
-                item = gallery_data[0]
-                media_id = item.get("media_id")
-                if media_id:
-                    media_info = media_metadata.get(media_id, {})
-                    mime_type = media_info.get("m", "")
-                    url = f"https://i.redd.it/{media_id}.jpg"
-
-                    if mime_type.startswith("image"):
-                        await self.process_image(
-                            url, title, post["url"], interaction, nsfw
-                        )
-                    elif mime_type.startswith("video"):
-                        await self.process_video(
-                            url, title, post["url"], interaction, nsfw
-                        )
-                    elif mime_type.endswith("gif"):
-                        await self.process_gif(
-                            url, title, post["url"], interaction, nsfw
+            attachments = []
+            links = []
+            for (url, filename), result in zip(items, results):
+                if isinstance(result, Attachment):
+                    attachments.append(result)
+                else:
+                    if isinstance(result, Exception):
+                        logger.warning(
+                            "Error downloading gallery item %s: %s", url, result
                         )
-                    else:
-                        print(f"Unknown media type for {media_id}")
+                    links.append(url)
+
+            content = f"{title}\n<{post.url}>"
+            if links:
+                content += "\n" + "\n".join(links)
+
+            # Pack the attachments into as few messages as Discord allows
+            messages = [
+                PreparedMessage(content if index == 0 else "", group)
+                for index, group in enumerate(group_attachments(attachments))
+            ]
+            return messages or [PreparedMessage(content)]
 
         except Exception as e:
-            print("Error processing gallery content:", e)
-            await interaction.followup.send(
-                f"An unexpected error occurred while processing the gallery: {e}"
-            )
+            logger.exception("Error processing gallery content")
+            if interaction:
+                await self.notify(
+                    interaction,
+                    f"An unexpected error occurred while processing the gallery: {e}",
+                )
+            return []
 
-    # Process the image and send it to the Discord channel
+    # Download the image and prepare it for the Discord channel
     async def process_image(
-        self, image_url, title, reddit_post_url=None, interaction=None, nsfw=False
+        self,
+        image_url,
+        title,
+        reddit_post_url=None,
+        interaction=None,
+        nsfw=False,
+        cache=False,
     ):
-        print("Image URL:", image_url)
+        logger.debug("Image URL: %s", image_url)
 
         image_filename = sanitize_filename(f"{title}.jpg")
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_url) as response:
-                content = await response.read()
-
-        with open(image_filename, "wb") as file:
-            file.write(content)
-
-        title_payload = {"content": f"{title}\n<{reddit_post_url}>"}
-        files = {"file": open(image_filename, "rb")}
+        attachment = await self.fetch_attachment(
+            image_url, image_filename, cache=cache
+        )
+        if attachment is None:
+            return PreparedMessage(f"{title}\n{image_url}")
 
-        try:
-            await self.send_to_discord_channel(title_payload, files, interaction)
-        finally:
-            files["file"].close()
-            os.remove(image_filename)
+        return PreparedMessage(f"{title}\n<{reddit_post_url}>", [attachment])
 
-    # Process the video and send it to the Discord channel
+    # Download or convert the video and prepare it for the Discord channel
     async def process_video(
-        self, video_url, title, backup_video=None, interaction=None, nsfw=False
+        self,
+        video_url,
+        title,
+        backup_video=None,
+        interaction=None,
+        nsfw=False,
+        dash_url=None,
+        cache=False,
     ):
-        print("Video URL:", video_url)
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(video_url, timeout=None) as response:
-                content_type = response.headers.get("Content-Type")
-
-                if (
-                    "application/vnd.apple.mpegurl" in content_type
-                    or "application/x-mpegurl" in content_type
-                ):
-                    # HLS stream detected, use FFmpeg to convert
-                    video_filename = sanitize_filename(f"{title}.mp4")
-
-                    ffmpeg_cmd = [
-                        "ffmpeg",
-                        "-i",
-                        video_url,
-                        "-c:v",
-                        "libx264",  # Video codec
-                        "-crf",
-                        "25",  # Constant Rate Factor (0-51, lower is better quality)
-                        "-preset",
-                        "veryfast",  # Preset for encoding speed vs. compression ratio
-                        "-max_muxing_queue_size",
-                        "1024",  # Max demux queue size
-                        "-c:a",
-                        "aac",  # Audio codec
-                        "-b:a",
-                        "128k",  # Audio bitrate
-                        "-bsf:a",
-                        "aac_adtstoasc",
-                        video_filename,
-                    ]
+        logger.debug("Video URL: %s", video_url)
 
-                    try:
-                        subprocess.run(
-                            ffmpeg_cmd, check=True, timeout=300
-                        )  # 5-minute timeout
-                        print(
-                            f"Successfully downloaded and processed video: {video_filename}"
-                        )
-
-                        # Check file size
-                        file_size = os.path.getsize(video_filename)
-                        if file_size == 0:
-                            print("Downloaded video file is empty")
-                            return
-                        elif file_size > 25 * 1024 * 1024:
-                            print(
-                                "Downloaded video file is too large to send to Discord"
-                            )
-                            title_payload = {"content": f"{title}\n{backup_video}"}
-                            await self.send_to_discord_channel(
-                                title_payload, files=None, interaction=interaction
-                            )
-                            return
+        # Converted videos are cached under the stream URL
+        attachment = await self.media_cache.attachment(
+            video_url, sanitize_filename(f"{title}.mp4")
+        )
+        if attachment is not None:
+            logger.info("Using cached video for %s", title)
+            return self.video_message(title, backup_video, nsfw, attachment)
 
-                        # Send video to Discord
+        async with self.session.get(video_url, timeout=None) as response:
+            content_type = response.headers.get("Content-Type", "")
 
-                        # Regular expression to remove the /DASH and everything after it
-                        trimmed_video_url = re.sub(r"/DASH.*", "", backup_video)
+            if not (
+                "application/vnd.apple.mpegurl" in content_type
+                or "application/x-mpegurl" in content_type
+            ):
+                # Regular video file, handle as before
+                return await self.download_video(response, video_url, title, nsfw)
 
-                        title_payload = {"content": f"{title}\n<{trimmed_video_url}>"}
-                        if nsfw:
-                            title_payload["content"] = (
-                                f"NSFW: {title}\n{trimmed_video_url}"
-                            )
-                        files = {"file": open(video_filename, "rb")}
+        # HLS stream detected, use FFmpeg to convert
+        video_filename = unique_temp_path(".mp4")
 
-                        await self.send_to_discord_channel(
-                            title_payload, files, interaction
-                        )
+        try:
+            method = None
+            if dash_url and VIDEO_DASH_SELECTION and VIDEO_REMUX_MODE != "never":
+                method = await self.convert_dash(
+                    dash_url, video_filename, title, interaction
+                )
+            if method is None:
+                method = await self.convert_hls(
+                    video_url, video_filename, title, interaction
+                )
+            if method is None:
+                logger.info("Video can't fit the Discord upload limit, posting a link")
+                os.remove(video_filename)
+                return PreparedMessage(f"{title}\n{backup_video}")
+            logger.info(
+                "Successfully downloaded and processed video (%s): %s",
+                method,
+                video_filename,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("FFmpeg process timed out")
+            os.remove(video_filename)
+            return None
+        except TranscodeError as e:
+            logger.warning("Error processing video: %s", e)
+            os.remove(video_filename)
+            return None
+        except BaseException:
+            # Any other failure, or cancellation when delivery stops early
+            os.remove(video_filename)
+            raise
+
+        # Check file size
+        file_size = os.path.getsize(video_filename)
+        if file_size == 0:
+            logger.warning("Downloaded video file is empty")
+            os.remove(video_filename)
+            return None
+        elif file_size > DISCORD_UPLOAD_LIMIT:
+            logger.info("Downloaded video file is too large to send to Discord")
+            os.remove(video_filename)
+            return PreparedMessage(f"{title}\n{backup_video}")
+
+        attachment = Attachment(sanitize_filename(f"{title}.mp4"), path=video_filename)
+        if cache:
+            await self.store_in_cache(video_url, attachment)
+        return self.video_message(title, backup_video, nsfw, attachment)
+
+    def video_message(self, title, backup_video, nsfw, attachment):
+        # Regular expression to remove the /DASH and everything after it
+        trimmed_video_url = re.sub(r"/DASH.*", "", backup_video)
+
+        content = f"{title}\n<{trimmed_video_url}>"
+        if nsfw:
+            content = f"NSFW: {title}\n{trimmed_video_url}"
+        return PreparedMessage(content, [attachment])
+
+    # Mux the best DASH video and audio renditions that fit the upload limit
+    # without re-encoding. Returns None if no rendition fits or muxing fails.
+    async def convert_dash(self, dash_url, video_filename, title, interaction):
+        try:
+            async with self.session.get(dash_url) as response:
+                response.raise_for_status()
+                manifest = await response.text()
+            duration, videos, audios = parse_manifest(manifest, dash_url)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning("Could not read DASH manifest %s: %s", dash_url, e)
+            return None
+
+        selection = select_renditions(
+            duration, videos, audios, DISCORD_UPLOAD_LIMIT * SIZE_BUDGET_MARGIN
+        )
+        if selection is None:
+            logger.info("No DASH rendition fits the upload limit")
+            return None
+
+        video, audio = selection
+        logger.debug(
+            "Selected DASH renditions: %s %s", video.url, audio.url if audio else ""
+        )
+        label = f"{video.height}p stream copy" if video.height else "stream copy"
+        try:
+            await self.transcoder.run(
+                mux_command(video.url, audio.url if audio else None, video_filename),
+                on_queued=self.video_queued_callback(title, interaction),
+                on_start=self.video_started_callback(title, interaction, label),
+            )
+        except TranscodeError as e:
+            logger.warning("DASH mux failed: %s", e)
+            return None
+        return "dash"
+
+    # Remux the stream when its codecs already suit Discord, otherwise
+    # transcode it, capping the bitrate so the result fits the upload limit.
+    # Returns which path was taken, or None if the video can't fit at all.
+    async def convert_hls(self, video_url, video_filename, title, interaction):
+        probe_info = None
+        if VIDEO_REMUX_MODE == "auto" or VIDEO_SIZE_BUDGET:
+            try:
+                probe_info = await self.transcoder.probe(video_url)
+            except (asyncio.TimeoutError, TranscodeError) as e:
+                logger.warning("Could not probe video: %s", e)
+
+        remux = VIDEO_REMUX_MODE == "always" or (
+            VIDEO_REMUX_MODE == "auto"
+            and probe_info is not None
+            and discord_compatible(probe_info)
+        )
+
+        max_video_bitrate = None
+        if VIDEO_SIZE_BUDGET and probe_info is not None:
+            size = estimated_size(probe_info)
+            if remux and size and size > DISCORD_UPLOAD_LIMIT:
+                logger.info("Stream copy would exceed the upload limit, encoding to fit")
+                remux = False
+
+            duration = media_duration(probe_info)
+            if duration and not remux:
+                max_video_bitrate = target_video_bitrate(
+                    duration, DISCORD_UPLOAD_LIMIT
+                )
+                if max_video_bitrate is None:
+                    return None
+
+        on_queued = self.video_queued_callback(title, interaction)
+        if remux:
+            try:
+                await self.transcoder.run(
+                    remux_command(video_url, video_filename),
+                    on_queued=on_queued,
+                    on_start=self.video_started_callback(
+                        title, interaction, "stream copy"
+                    ),
+                )
+                return "remux"
+            except TranscodeError as e:
+                logger.warning("Remux failed, transcoding instead: %s", e)
+
+        await self.transcoder.run(
+            transcode_command(video_url, video_filename, max_video_bitrate),
+            on_queued=on_queued,
+            on_start=self.video_started_callback(title, interaction, "transcoding"),
+        )
+        return "transcode"
+
+    # Save a directly linked video file
+    async def download_video(self, response, video_url, title, nsfw):
+        content_length = response.headers.get("Content-Length")
+        if content_length and int(content_length) > DISCORD_UPLOAD_LIMIT:
+            logger.info("Video at %s is larger than 25MB, skipping processing", video_url)
+            return PreparedMessage(f"{title}\n{video_url}")
+
+        extension = os.path.splitext(urlparse(video_url).path)[1] or ".mp4"
+        video_filename = sanitize_filename(f"{title}{extension}")
+        with STAGE_SECONDS.time(stage="download", media_type="video"):
+            attachment = await self.read_attachment(response, video_filename, "video")
+        if attachment is None:
+            return PreparedMessage(f"{title}\n{video_url}")
+
+        content = f"{title}\n{video_url}"
+        if nsfw:
+            content = f"NSFW: {title}\n{video_url}"
+        return PreparedMessage(content, [attachment])
+
+    # Pre-flight check: returns a link-only message if the file is known
+    # to be over the upload limit, so it is never downloaded
+    async def link_if_too_large(self, url, title):
+        if await self.media_probe.classify_file(url) == LINK_ONLY:
+            logger.info("%s is larger than the upload limit, posting a link", url)
+            return PreparedMessage(f"{title}\n{url}")
+        return None
+
+    # Download a file to upload, or return None if it is over the upload
+    # limit. The pre-flight probe means oversized files are never fetched.
+    async def fetch_attachment(self, url, filename, media_type="image", cache=False):
+        attachment = await self.media_cache.attachment(url, filename)
+        if attachment is not None:
+            return attachment
+
+        if await self.media_probe.classify_file(url) == LINK_ONLY:
+            logger.info("%s is larger than the upload limit, posting a link", url)
+            return None
+
+        with STAGE_SECONDS.time(stage="download", media_type=media_type):
+            async with self.session.get(url) as response:
+                response.raise_for_status()
+                attachment = await self.read_attachment(response, filename, media_type)
+        if cache and attachment is not None:
+            await self.store_in_cache(url, attachment)
+        return attachment
+
+    async def store_in_cache(self, url, attachment):
+        try:
+            await self.media_cache.store(url, attachment)
+        except BaseException:
+            attachment.cleanup()
+            raise
+
+    # Stream a response body into memory, spilling to a temporary file
+    # if it grows past the in-memory limit. Returns None if the body turns
+    # out to be larger than the upload limit.
+    async def read_attachment(self, response, filename, media_type="image"):
+        buffer = AttachmentBuffer(filename)
+        received = 0
+        try:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                DOWNLOADED_BYTES.inc(len(chunk), media_type=media_type)
+                if received > DISCORD_UPLOAD_LIMIT:
+                    buffer.abort()
+                    return None
+                buffer.write(chunk)
+        except BaseException:
+            buffer.abort()
+            raise
+        return buffer.finish()
+
+    # Send a progress or error followup. These are best-effort: a followup
+    # that fails, e.g. once the interaction token has expired, is logged
+    # instead of failing the post.
+    async def notify(self, interaction, content):
+        try:
+            await interaction.followup.send(content)
+        except discord.HTTPException as e:
+            logger.warning("Could not send followup: %s", e)
+
+    # Let the user know their video is waiting for a free ffmpeg worker
+    def video_queued_callback(self, title, interaction):
+        if interaction is None:
+            return None
+
+        async def on_queued(position):
+            await self.notify(
+                interaction,
+                f"Video queued for processing (position {position}): {title}",
+            )
 
-                        files["file"].close()
-                        os.remove(video_filename)
+        return on_queued
 
-                    except subprocess.TimeoutExpired:
-                        print("FFmpeg process timed out")
-                        return
-                    except subprocess.CalledProcessError as e:
-                        print(f"Error processing video: {e}")
-                        return
+    def video_started_callback(self, title, interaction, method):
+        if interaction is None:
+            return None
 
-                else:
-                    # Regular video file, handle as before
-                    content_length = response.headers.get("Content-Length")
-                    if (
-                        content_length and int(content_length) > 25 * 1024 * 1024
-                    ):  # 25MB limit
-                        print(
-                            f"Video at {video_url} is larger than 25MB, skipping processing."
-                        )
-                        title_payload = {"content": f"{title}\n{video_url}"}
-                        await self.send_to_discord_channel(
-                            title_payload, files=None, interaction=interaction
-                        )
-                        return
-
-                    extension = os.path.splitext(urlparse(video_url).path)[1] or ".mp4"
-                    video_filename = sanitize_filename(f"{title}{extension}")
-
-                    with open(video_filename, "wb") as video_file:
-                        while True:
-                            chunk = await response.content.read(1024)
-                            if not chunk:
-                                break
-                            video_file.write(chunk)
-
-                    # Send video to Discord
-                    title_payload = {"content": f"{title}\n{video_url}"}
-                    if nsfw:
-                        title_payload["content"] = f"NSFW: {title}\n{video_url}"
-                    files = {"file": open(video_filename, "rb")}
-
-                    await self.send_to_discord_channel(
-                        title_payload, files, interaction
-                    )
+        async def on_start():
+            await self.notify(interaction, f"Processing video ({method}): {title}")
 
-                    files["file"].close()
-                    os.remove(video_filename)
+        return on_start
 
-    # Process the gif and send it to the Discord channel
+    # Download the gif and prepare it for the Discord channel
     async def process_gif(
-        self, gif_url, title, reddit_post_url=None, interaction=None, nsfw=False
+        self,
+        gif_url,
+        title,
+        reddit_post_url=None,
+        interaction=None,
+        nsfw=False,
+        cache=False,
     ):
-        print("Gif URL:", gif_url)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(gif_url) as response:
-                content = await response.read()
+        logger.debug("Gif URL: %s", gif_url)
 
         gif_filename = sanitize_filename(f"{title}.gif")
 
-        with open(gif_filename, "wb") as file:
-            file.write(content)
-
-        title_payload = {"content": f"{title}\n<{reddit_post_url}>"}
-        files = {"file": open(gif_filename, "rb")}
-
-        await self.send_to_discord_channel(title_payload, files, interaction)
-
-        files["file"].close()
-        os.remove(gif_filename)
-
-    async def send_to_discord_channel(self, title_payload, files, interaction):
-        # check the channel the command was called from,
-        # and send the message to that channel
-        text_channel = interaction.channel
-
-        print(f"Sending message to channel: {text_channel}")
-
-        # send the message with the title payload
-        await text_channel.send(content=title_payload["content"])
-
-        # send the files if there are any
-        if files:
-            for key, value in files.items():
-                if value:
-                    if key == "file" and not title_payload["content"].endswith(
-                        (".jpg", ".jpeg", ".png")
-                    ):
-                        await text_channel.send(file=discord.File(value))
-                    files[key].close()
-
-        return
+        attachment = await self.fetch_attachment(
+            gif_url, gif_filename, "gif", cache
+        )
+        if attachment is None:
+            return PreparedMessage(f"{title}\n{gif_url}")
+
+        return PreparedMessage(f"{title}\n<{reddit_post_url}>", [attachment])
+
+
+# File extension for a gallery item's mime type, or None if unsupported
+def gallery_extension(mime_type):
+    if mime_type in ("image/jpg", "image/jpeg"):
+        return "jpg"
+    elif mime_type in ("image/png", "image/gif", "image/webp"):
+        return mime_type.split("/")[1]
+    elif mime_type.startswith("video"):
+        return "mp4"
+    return None
+
+
+# Split attachments into groups that each fit in one Discord message,
+# keeping their order
+def group_attachments(
+    attachments, max_files=MAX_ATTACHMENTS_PER_MESSAGE, max_bytes=DISCORD_UPLOAD_LIMIT
+):
+    groups = []
+    group = []
+    group_size = 0
+    for attachment in attachments:
+        size = attachment.size
+        if group and (len(group) >= max_files or group_size + size > max_bytes):
+            groups.append(group)
+            group = []
+            group_size = 0
+        group.append(attachment)
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
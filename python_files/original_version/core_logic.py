@@ -34,7 +34,7 @@ import praw
 import random
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # check if being ran by a docker container
@@ -48,8 +48,8 @@ if os.getenv("CHECK_ENV"):
     DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
     WEBHOOK = os.getenv("WEBHOOK")
     
-    print("DISCORD_TOKEN FROM CLI:", DISCORD_TOKEN)
-    print("WEBHOOK FROM CLI:", WEBHOOK)
+    logger.debug("DISCORD_TOKEN set from CLI: %s", DISCORD_TOKEN is not None)
+    logger.debug("WEBHOOK set from CLI: %s", WEBHOOK is not None)
     
 else:
     # Running in a web server environment (e.g., Azure App Service, Heroku)
@@ -58,13 +58,13 @@ else:
     vault_url = "https://FeashDiscordBot.vault.azure.net"
 
     # Create a secret client
-    logger = logging.getLogger("azure.identity")
-    logger.setLevel(logging.INFO)
+    azure_logger = logging.getLogger("azure.identity")
+    azure_logger.setLevel(logging.INFO)
 
     handler = logging.StreamHandler(stream=sys.stdout)
     formatter = logging.Formatter("[%(levelname)s %(name)s] %(message)s")
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    azure_logger.addHandler(handler)
     credential = DefaultAzureCredential()  # ManagedIdentityCredential()
     client = SecretClient(vault_url=vault_url, credential=credential)
 
@@ -72,8 +72,8 @@ else:
     DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
     WEBHOOK = os.getenv("WEBHOOK")
 
-    print("DISCORD_TOKEN:", DISCORD_TOKEN)
-    print("WEBHOOK:", WEBHOOK)
+    logger.debug("DISCORD_TOKEN set: %s", DISCORD_TOKEN is not None)
+    logger.debug("WEBHOOK set: %s", WEBHOOK is not None)
 
 # Function to sanitize the filename of the image or video scraped from Reddit
 def sanitize_filename(filename):
@@ -285,15 +285,15 @@ class ScraperBot:
     # Scroll down the page to load more posts
     def scroll_down(self):
         try:
-            print("Scrolling down...")
+            logger.debug("Scrolling down...")
             self.driver.execute_script(
                 "window.scrollTo(0, document.body.scrollHeight);"
             )
-            print("Waiting for posts to load...")
+            logger.debug("Waiting for posts to load...")
                    # Random delay
             time.sleep(random.uniform(2, 5))
         except Exception as e:
-            print(f"Error scrolling down: {e}")
+            logger.warning("Error scrolling down: %s", e)
 
     # Select the number of posts to scrape from the subreddit
     def select_posts(self, num_posts):
@@ -305,12 +305,11 @@ class ScraperBot:
             ):  # Keep scrolling until we have the desired number of posts
 
                 article_elements = self.driver.find_elements(By.TAG_NAME, "article")
-                print(f"Found {len(article_elements)} articles so far.")
-                
-                # get the whole html of the page
-                html = self.driver.page_source
-                
-                print(html)
+                logger.info("Found %d articles so far.", len(article_elements))
+
+                # Dumping the whole page is only useful when debugging selectors
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Page source: %s", self.driver.page_source)
             
                 for post in article_elements:
 
@@ -323,9 +322,9 @@ class ScraperBot:
                             post_url not in posts
                         ):  # If the post is not already in the list, add it
                             posts.append(post_url)
-                            print(f"Post {len(posts)}: {post_url}")
+                            logger.info("Post %d: %s", len(posts), post_url)
                     except Exception as e:
-                        print(f"Error finding post link: {e}")
+                        logger.warning("Error finding post link: %s", e)
 
                 if (
                     len(posts) < num_posts
@@ -334,7 +333,7 @@ class ScraperBot:
 
             return posts
         except Exception as e:
-            print(f"Error: {e}")
+            logger.exception("Error selecting posts")
 
     async def send_to_discord_channel(self, title_payload, files, interaction):
         # check the channel the command was called from,